@@ -0,0 +1,483 @@
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import main
+from main import print_status, find_most_used_color, find_most_used_color_fast, determine_best_bar_color
+
+# Function to get the most used color the way SpotyScan originally did it
+def legacy_most_used_color(img):
+    img = img.convert('RGB')
+    pixels = list(img.getdata())
+    return Counter(pixels).most_common(1)[0][0]
+
+# Function to generate synthetic 640x640 covers when no local images are given
+def generate_covers(count=8, size=640, seed=1):
+    rng = random.Random(seed)
+    covers = []
+    for index in range(count):
+        if index % 4 == 0:
+            # Flat artwork, the typical single-colour background
+            img = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+        elif index % 4 == 1:
+            # Smooth gradient, many colours with near-equal counts
+            img = Image.linear_gradient('L').resize((size, size)).convert('RGB')
+        elif index % 4 == 2:
+            # Pure noise, the worst case for the histogram
+            img = Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+        else:
+            # Posterized noise, lots of ties between the top colours
+            noise = Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+            img = noise.quantize(colors=4).convert('RGB')
+
+        # Round trip through JPEG so the pixels look like a real cover
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        covers.append((f"synthetic-{index}.jpg", buffer.getvalue()))
+    return covers
+
+# Function to load covers from a folder of images
+def load_covers(folder):
+    covers = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+            with open(os.path.join(folder, name), 'rb') as file:
+                covers.append((name, file.read()))
+    return covers
+
+# Function to time a color picker over decoded covers
+def time_picker(picker, images, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for img in images:
+            picker(img)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(images)
+
+# Function to measure the peak Python allocation of a color picker on one image
+def peak_allocation(picker, img):
+    tracemalloc.start()
+    picker(img)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+# Function to compare the legacy and current most used color implementations
+def benchmark_colors(covers, rounds):
+    images = []
+    for name, data in covers:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        images.append((name, img))
+
+    mismatches = [name for name, img in images if legacy_most_used_color(img) != find_most_used_color(img)]
+    for name in mismatches:
+        print_status(f"Result mismatch for {name}", "ERROR")
+
+    decoded = [img for _, img in images]
+    legacy_time = time_picker(legacy_most_used_color, decoded, rounds)
+    current_time = time_picker(find_most_used_color, decoded, rounds)
+
+    legacy_peak = max(peak_allocation(legacy_most_used_color, img) for img in decoded)
+    current_peak = max(peak_allocation(find_most_used_color, img) for img in decoded)
+
+    print_status(f"Images: {len(decoded)}, identical results: {len(decoded) - len(mismatches)}/{len(decoded)}", "INFO")
+    print_status(f"list(getdata()) + Counter: {legacy_time * 1000:.2f} ms/image, peak {legacy_peak / 2**20:.1f} MiB", "STATUS")
+    print_status(f"find_most_used_color:      {current_time * 1000:.2f} ms/image, peak {current_peak / 2**20:.1f} MiB", "STATUS")
+    print_status(f"Speedup: {legacy_time / current_time:.1f}x", "SUCCESS")
+    return not mismatches
+
+# Function to time one picker on freshly opened covers, decode included
+def time_decode_and_pick(picker, covers, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _, data in covers:
+            with Image.open(io.BytesIO(data)) as img:
+                picker(img)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(covers)
+
+# Function to measure accuracy and speed of the fast picker against the exact one
+def benchmark_pickers(covers, rounds, quantize_bits):
+    variants = [("fast", lambda img: find_most_used_color_fast(img))]
+    for bits in quantize_bits:
+        variants.append((f"fast+q{bits}", lambda img, bits=bits: find_most_used_color_fast(img, quantize_bits=bits)))
+
+    exact_colors = []
+    for _, data in covers:
+        with Image.open(io.BytesIO(data)) as img:
+            exact_colors.append(find_most_used_color(img))
+
+    exact_time = time_decode_and_pick(find_most_used_color, covers, rounds)
+    print_status(f"Covers: {len(covers)}", "INFO")
+    print_status(f"exact:    {exact_time * 1000:.2f} ms/image", "STATUS")
+
+    for label, picker in variants:
+        distances = []
+        same_bar_color = 0
+        for (_, data), exact_color in zip(covers, exact_colors):
+            with Image.open(io.BytesIO(data)) as img:
+                color = picker(img)
+            distances.append(math.dist(color, exact_color))
+            same_bar_color += determine_best_bar_color(color) == determine_best_bar_color(exact_color)
+
+        picker_time = time_decode_and_pick(picker, covers, rounds)
+        print_status(
+            f"{label:<9} {picker_time * 1000:.2f} ms/image ({exact_time / picker_time:.1f}x), "
+            f"mean RGB distance {sum(distances) / len(distances):.1f}, "
+            f"same bar color {same_bar_color}/{len(covers)}",
+            "STATUS",
+        )
+
+# Function to composite the way SpotyScan originally did it: a new canvas per image and no mode conversion
+def legacy_combine_image_bytes(cover_bytes, code_bytes):
+    cover_image = Image.open(io.BytesIO(cover_bytes))
+    code_image = Image.open(io.BytesIO(code_bytes))
+    combined_image = Image.new('RGB', (cover_image.width, cover_image.height + code_image.height))
+    combined_image.paste(cover_image, (0, 0))
+    combined_image.paste(code_image, (0, cover_image.height))
+
+    buffer = io.BytesIO()
+    combined_image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+# Function to generate Spotify-code-like images in the modes codes come in
+def generate_codes(size=640):
+    codes = []
+    for mode in ('RGB', 'P', 'RGBA'):
+        img = Image.new('RGB', (size, size // 4), (40, 40, 40))
+        for index in range(23):
+            left = size // 4 + index * 20
+            img.paste((255, 255, 255), (left, 40, left + 10, 120))
+        if mode == 'P':
+            img = img.quantize(colors=8)
+        elif mode == 'RGBA':
+            img.putalpha(255)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG')
+        codes.append((mode, buffer.getvalue()))
+    return codes
+
+# Function to time a compositing function and count the Pillow images it allocates per call
+def time_composite(combine, cover_bytes, code_bytes, rounds):
+    combine(cover_bytes, code_bytes)
+    before = Image.core.get_stats()['new_count']
+    start = time.perf_counter()
+    for _ in range(rounds):
+        combine(cover_bytes, code_bytes)
+    elapsed = (time.perf_counter() - start) / rounds
+    return elapsed, (Image.core.get_stats()['new_count'] - before) / rounds
+
+# Function to compare the legacy compositing with the compositor and its layout templates
+def benchmark_compose(covers, rounds):
+    cover_bytes = covers[0][1]
+    for mode, code_bytes in generate_codes():
+        legacy_time, legacy_images = time_composite(legacy_combine_image_bytes, cover_bytes, code_bytes, rounds)
+        print_status(f"code {mode:<4} legacy             {legacy_time * 1000:6.2f} ms/image, {legacy_images:.1f} images allocated", "STATUS")
+        for layout_name in main.LAYOUT_TEMPLATES:
+            combine = lambda cover, code, layout_name=layout_name: main.combine_image_bytes(cover, code, 'JPEG', layout_name)
+            layout_time, layout_images = time_composite(combine, cover_bytes, code_bytes, rounds)
+            print_status(f"code {mode:<4} {layout_name:<18} {layout_time * 1000:6.2f} ms/image, {layout_images:.1f} images allocated", "STATUS")
+
+# End-to-end flows the flows benchmark can run against the mock server
+FLOWS = [
+    "single-cover",
+    "playlist-cover",
+    "links-cover",
+    "single-code",
+    "playlist-code",
+    "links-code",
+    "albums-cover",
+    "albums-code",
+    "sync-code",
+]
+
+# Function to get a percentile of already sorted samples
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+# Per-track latency recorder hooked around the functions that handle one track
+class TrackTimer:
+    def __init__(self):
+        self.started = {}
+        self.latencies = []
+
+    def wrap(self, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+        return timed
+
+    def wrap_async(self, function):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+        return timed
+
+    def install(self):
+        main.save_cover_image = self.wrap(main.save_cover_image)
+        main.render_track_with_code = self.wrap(main.render_track_with_code)
+        main.render_track_with_code_async = self.wrap_async(main.render_track_with_code_async)
+
+        # Pipeline jobs are timed from the moment they enter the pipeline until they leave it
+        submit, finish = main.CodePipeline.submit, main.CodePipeline._finish
+
+        def timed_submit(pipeline, job):
+            submit(pipeline, job)
+            self.started.setdefault(job.spotify_uri, time.perf_counter())
+
+        def timed_finish(pipeline, job, failed_stage):
+            end = time.perf_counter()
+            self.latencies.append(max(0.0, end - self.started.pop(job.spotify_uri, end)))
+            finish(pipeline, job, failed_stage)
+
+        main.CodePipeline.submit = timed_submit
+        main.CodePipeline._finish = timed_finish
+
+# Function to point SpotyScan at the mock server and keep its output out of the way
+def configure_for_mock(config, work_dir):
+    main.SPOTIFY_ACCOUNTS_URL = config["urls"]["accounts"]
+    main.SPOTIFY_API_URL = config["urls"]["api"]
+    main.SPOTIFY_CODES_URL = config["urls"]["codes"]
+    main.HTTP_ENGINE = config["engine"]
+    main.HTTP_POOL_MAXSIZE = config["pool_size"]
+    main.QUIET = True
+
+    # Apply the real hosts' rate and concurrency limits to the mock hosts standing in for them
+    aliases = config["host_aliases"]
+    main.HOST_RATE_LIMITS = {aliases.get(host, host): rate for host, rate in main.HOST_RATE_LIMITS.items()}
+    main.HOST_CONCURRENCY = {aliases.get(host, host): limit for host, limit in main.HOST_CONCURRENCY.items()}
+    main.rate_limiter = main.RateLimitController()
+
+    main.cover_cache.cache_dir = os.path.join(work_dir, "cache", "covers")
+    main.code_cache.cache_dir = os.path.join(work_dir, "cache", "codes")
+    main.metadata_store.path = os.path.join(work_dir, "cache", "metadata.sqlite3")
+    os.chdir(work_dir)
+
+# Function to get the peak RSS in bytes of this process and of its finished worker processes, None where unknown
+def peak_memory():
+    # resource only exists on Unix
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource:
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    try:
+        import psutil
+    except ImportError:
+        return None, None
+    # Windows reports the peak working set, and the workers have exited by now
+    return getattr(psutil.Process().memory_info(), "peak_wset", None), None
+
+# Function to format a byte count in MiB for the results table
+def format_mib(size):
+    return "n/a" if size is None else f"{size / 2**20:.1f}"
+
+# Function to run one flow against the mock server, called in a fresh process so peak RSS belongs to that flow
+def run_flow(flow, config):
+    with tempfile.TemporaryDirectory() as work_dir:
+        configure_for_mock(config, work_dir)
+        timer = TrackTimer()
+        timer.install()
+
+        links_file = os.path.join(work_dir, "links.txt")
+        with open(links_file, "w") as file:
+            file.write("\n".join(config["track_urls"]) + "\n")
+        albums_file = os.path.join(work_dir, "albums.txt")
+        with open(albums_file, "w") as file:
+            file.write("\n".join(config["album_urls"]) + "\n")
+
+        runners = {
+            "single-cover": lambda: main.process_single_song(config["track_urls"][0]),
+            "playlist-cover": lambda: main.process_playlist(config["playlist_url"]),
+            "links-cover": lambda: main.process_song_links_from_file(links_file),
+            "single-code": lambda: main.process_single_song_with_code(config["track_urls"][0]),
+            "playlist-code": lambda: main.process_playlist_with_code(config["playlist_url"]),
+            "links-code": lambda: main.process_song_links_with_code_from_file(links_file),
+            "albums-cover": lambda: main.process_song_links_from_file(albums_file),
+            "albums-code": lambda: main.process_song_links_with_code_from_file(albums_file),
+            "sync-code": lambda: main.sync_playlist_with_code(config["playlist_url"]),
+        }
+
+        start = time.perf_counter()
+        runners[flow]()
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(timer.latencies)
+    peak_rss, peak_rss_workers = peak_memory()
+    return {
+        "flow": flow,
+        "tracks": len(latencies),
+        "seconds": elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+        "errors": main.STATUS_COUNTS["ERROR"],
+        "peak_rss": peak_rss,
+        "peak_rss_workers": peak_rss_workers,
+    }
+
+# Function to run every flow in its own process against one mock server and report the results
+def benchmark_flows(flows, tracks, engine, latency, rate_429, pool_size):
+    from mock_spotify import TRACKS_PER_ALBUM, MockSpotify
+
+    results = []
+    with MockSpotify(latency=latency, rate_429=rate_429) as mock:
+        config = {
+            "urls": {service: mock.url(service) for service in ("accounts", "api", "codes")},
+            "host_aliases": mock.host_aliases(),
+            "engine": engine,
+            "pool_size": pool_size,
+            "playlist_url": mock.playlist_url(tracks),
+            "track_urls": [mock.track_url(index) for index in range(tracks)],
+            # The albums holding the same number of tracks
+            "album_urls": [mock.album_url(index) for index in range(-(-tracks // TRACKS_PER_ALBUM))],
+        }
+
+        for flow in flows:
+            mock.reset_stats()
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "run-flow", flow, json.dumps(config)],
+                capture_output=True, text=True,
+            )
+            result_lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+            if completed.returncode != 0 or not result_lines:
+                print_status(f"{flow} failed: {completed.stderr.strip().splitlines()[-1:] or completed.returncode}", "ERROR")
+                continue
+
+            result = json.loads(result_lines[-1])
+            stats = mock.stats()
+            result["calls"] = stats["calls"]
+            result["api_bytes"] = stats["bytes"].get("api", 0)
+            result["connections"] = sum(stats["connections"].values())
+            results.append(result)
+
+    print_status(f"Tracks: {tracks}, engine: {engine}, latency: {latency * 1000:.0f} ms, 429 rate: {rate_429:.0%}, "
+                 f"pool size: {pool_size or 'default'}", "INFO")
+    print_status(f"{'flow':<14}{'tracks/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'API/track':>11}{'API B/track':>13}{'CDN':>6}{'codes':>7}{'conns':>7}{'RSS MiB':>9}{'workers':>9}", "INFO")
+    for result in results:
+        calls = result["calls"]
+        per_track = max(result["tracks"], 1)
+        status = "ERROR" if result["errors"] else "STATUS"
+        print_status(
+            f"{result['flow']:<14}"
+            f"{result['tracks'] / result['seconds']:>10.1f}"
+            f"{result['p50'] * 1000:>9.1f}"
+            f"{result['p99'] * 1000:>9.1f}"
+            f"{(calls.get('api', 0) + calls.get('accounts', 0)) / per_track:>11.2f}"
+            f"{result['api_bytes'] / per_track:>13.0f}"
+            f"{calls.get('cdn', 0):>6}"
+            f"{calls.get('codes', 0):>7}"
+            f"{result['connections']:>7}"
+            f"{format_mib(result['peak_rss']):>9}"
+            f"{format_mib(result['peak_rss_workers']):>9}",
+            status,
+        )
+    return results
+
+# Function to time concurrent cover downloads from the mock CDN through sessions with different pool sizes
+def benchmark_pool(downloads, workers, latency, pool_sizes):
+    from mock_spotify import MockSpotify
+
+    # A full pool makes urllib3 warn on every dropped connection, which is the behavior being measured
+    logging.getLogger("urllib3").setLevel(logging.ERROR)
+
+    with MockSpotify(latency=latency, cover_size=300) as mock:
+        cover_hashes = [f"{index:040x}" for index in range(downloads)]
+        # Generate the covers up front so the server does not compete with the clients for the CPU
+        for cover_hash in cover_hashes:
+            mock.cover(cover_hash)
+        urls = [f"{mock.url('cdn')}/image/{cover_hash}" for cover_hash in cover_hashes]
+
+        print_status(f"Downloads: {downloads}, threads: {workers}, latency: {latency * 1000:.0f} ms", "INFO")
+        print_status(f"{'pool size':<12}{'downloads/s':>13}{'connections':>13}", "INFO")
+        for pool_size in pool_sizes:
+            main.HTTP_POOL_MAXSIZE = pool_size
+            mock.reset_stats()
+            with main.new_session() as session, ThreadPoolExecutor(max_workers=workers) as executor:
+                start = time.perf_counter()
+                list(executor.map(lambda url: session.get(url).content, urls))
+                elapsed = time.perf_counter() - start
+            connections = sum(mock.stats()["connections"].values())
+            print_status(f"{pool_size:<12}{downloads / elapsed:>13.1f}{connections:>13}", "STATUS")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SpotyScan micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    colors_parser = subparsers.add_parser("colors", help="compare most used color implementations")
+    colors_parser.add_argument("folder", nargs="?", help="folder of cover images (synthetic covers when omitted)")
+    colors_parser.add_argument("--rounds", type=int, default=3)
+
+    pickers_parser = subparsers.add_parser("pickers", help="measure the fast color picker against the exact one")
+    pickers_parser.add_argument("folder", nargs="?", help="folder of cover images (synthetic covers when omitted)")
+    pickers_parser.add_argument("--rounds", type=int, default=3)
+    pickers_parser.add_argument("--quantize-bits", type=int, nargs="*", default=[4, 5])
+
+    compose_parser = subparsers.add_parser("compose", help="measure time and image allocations of compositing")
+    compose_parser.add_argument("folder", nargs="?", help="folder of cover images (synthetic covers when omitted)")
+    compose_parser.add_argument("--rounds", type=int, default=50)
+
+    flows_parser = subparsers.add_parser("flows", help="run the process_* flows end to end against a local mock server")
+    flows_parser.add_argument("flows", nargs="*", help=f"flows to run, all when omitted ({', '.join(FLOWS)})")
+    flows_parser.add_argument("--tracks", type=int, default=200, help="tracks in the playlist and link file")
+    flows_parser.add_argument("--engine", choices=["sync", "async"], default="sync")
+    flows_parser.add_argument("--latency", type=float, default=0.02, help="seconds the mock server adds to every response")
+    flows_parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests the mock server answers with 429")
+    flows_parser.add_argument("--pool-size", type=int, help="connections SpotyScan keeps open per host (its default when omitted)")
+
+    pool_parser = subparsers.add_parser("pool", help="measure concurrent downloads at different connection pool sizes")
+    pool_parser.add_argument("--downloads", type=int, default=400)
+    pool_parser.add_argument("--workers", type=int, default=main.NETWORK_WORKERS + main.PLAYLIST_PAGE_WORKERS, help="download threads")
+    pool_parser.add_argument("--latency", type=float, default=0.02, help="seconds the mock server adds to every response")
+    pool_parser.add_argument("--pool-sizes", type=int, nargs="+", default=[10, 20], help="pool sizes to compare (10 is the requests default)")
+
+    run_flow_parser = subparsers.add_parser("run-flow", help=argparse.SUPPRESS)
+    run_flow_parser.add_argument("flow", choices=FLOWS)
+    run_flow_parser.add_argument("config")
+
+    args = parser.parse_args()
+
+    if args.command == "colors":
+        covers = load_covers(args.folder) if args.folder else generate_covers()
+        raise SystemExit(0 if benchmark_colors(covers, args.rounds) else 1)
+    elif args.command == "pickers":
+        covers = load_covers(args.folder) if args.folder else generate_covers()
+        benchmark_pickers(covers, args.rounds, args.quantize_bits)
+    elif args.command == "compose":
+        covers = load_covers(args.folder) if args.folder else generate_covers()
+        benchmark_compose(covers, args.rounds)
+    elif args.command == "flows":
+        unknown_flows = sorted(set(args.flows) - set(FLOWS))
+        if unknown_flows:
+            parser.error(f"unknown flows: {', '.join(unknown_flows)}")
+        benchmark_flows(args.flows or FLOWS, args.tracks, args.engine, args.latency, args.rate_429, args.pool_size)
+    elif args.command == "pool":
+        benchmark_pool(args.downloads, args.workers, args.latency, args.pool_sizes)
+    elif args.command == "run-flow":
+        print(json.dumps(run_flow(args.flow, json.loads(args.config))))
@@ -1,16 +1,58 @@
 import requests
 import re
+import argparse
 import os
-from concurrent.futures import ThreadPoolExecutor
-from PIL import Image
-from collections import Counter
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import sqlite3
+import asyncio
+import zipfile
+import threading
+from io import BytesIO
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from PIL import Image, ImageChops, ImageColor, ImageDraw
+from requests.adapters import HTTPAdapter
 from colorama import init, Fore, Style
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Initialize colorama
 init(autoreset=True)
 
+# Stream status messages are printed to (None prints to stdout)
+STATUS_STREAM = None
+
+# Format of status messages: "text" for colored lines, "json" for one JSON object per line
+LOG_FORMAT = "text"
+
+# Only print errors and warnings
+QUIET = False
+
+# Number of status messages printed per status, used for the exit code of the command line
+STATUS_COUNTS = Counter()
+
 # Helper function to print colored messages
 def print_status(message, status="INFO"):
+    STATUS_COUNTS[status] += 1
+    if QUIET and status not in ("ERROR", "WARNING"):
+        return
+    if LOG_FORMAT == "json":
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "status": status, "message": message}
+        print(json.dumps(entry), file=STATUS_STREAM or sys.stdout, flush=True)
+        return
+
     status_colors = {
         "SUCCESS": Fore.GREEN,
         "INFO": Fore.CYAN,
@@ -19,7 +61,147 @@ def print_status(message, status="INFO"):
         "STATUS": Fore.MAGENTA
     }
     color = status_colors.get(status, Fore.WHITE)
-    print(f"{color}[{status}] {message}")
+    print(f"{color}[{status}] {message}", file=STATUS_STREAM or sys.stdout)
+
+# File run metrics are written to at the end of a run (None turns the instrumentation off)
+METRICS_FILE = None
+
+# Format of the metrics file: "json" for one JSON object per line, "prometheus" for the Prometheus text format
+METRICS_FORMAT = "json"
+
+# Times one use of a stage
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+# Stage that does nothing, handed out while the instrumentation is off
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_STAGE = NullStage()
+
+# Per-stage timings and labelled counters of one run
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # stage -> [calls, total seconds, slowest call in seconds]
+        self.stages = {}
+        # (name, ((label, value), ...)) -> value
+        self.counters = Counter()
+
+    def stage(self, stage):
+        if not self.enabled:
+            return NULL_STAGE
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+
+    def add(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {"stages": {stage: list(totals) for stage, totals in self.stages.items()}, "counters": dict(self.counters)}
+
+    # Adds a snapshot taken in a worker process
+    def merge(self, snapshot):
+        with self._lock:
+            for stage, (calls, seconds, slowest) in snapshot["stages"].items():
+                totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                totals[0] += calls
+                totals[1] += seconds
+                totals[2] = max(totals[2], slowest)
+            self.counters.update(snapshot["counters"])
+
+    def json_lines(self):
+        snapshot = self.snapshot()
+        lines = []
+        for stage, (calls, seconds, slowest) in sorted(snapshot["stages"].items()):
+            lines.append({"type": "stage", "stage": stage, "calls": calls, "seconds": round(seconds, 6), "max_seconds": round(slowest, 6)})
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            lines.append({"type": "counter", "name": name, "labels": dict(labels), "value": value})
+        return "".join(json.dumps(line) + "\n" for line in lines)
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP spotyscan_stage_seconds_total Time spent in each stage.",
+            "# TYPE spotyscan_stage_seconds_total counter",
+        ]
+        lines += [f'spotyscan_stage_seconds_total{{stage="{stage}"}} {totals[1]:.6f}' for stage, totals in sorted(snapshot["stages"].items())]
+        lines += ["# HELP spotyscan_stage_calls_total Times each stage ran.", "# TYPE spotyscan_stage_calls_total counter"]
+        lines += [f'spotyscan_stage_calls_total{{stage="{stage}"}} {totals[0]}' for stage, totals in sorted(snapshot["stages"].items())]
+        lines += ["# HELP spotyscan_stage_max_seconds Slowest single run of each stage.", "# TYPE spotyscan_stage_max_seconds gauge"]
+        lines += [f'spotyscan_stage_max_seconds{{stage="{stage}"}} {totals[2]:.6f}' for stage, totals in sorted(snapshot["stages"].items())]
+
+        typed = set()
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE spotyscan_{name}_total counter")
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+            lines.append(f"spotyscan_{name}_total{{{label_text}}} {value}" if label_text else f"spotyscan_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Function to run a function in a worker process with the instrumentation on, returning its result and timings
+def call_with_metrics(function, *args):
+    metrics.enabled = True
+    metrics.reset()
+    result = function(*args)
+    return result, metrics.snapshot()
+
+# Function to submit CPU work to a process pool, folding the worker's timings into this process's metrics
+def submit_cpu_work(pool, function, *args):
+    if not metrics.enabled:
+        return pool.submit(function, *args)
+
+    outer_future = Future()
+    inner_future = pool.submit(call_with_metrics, function, *args)
+
+    def unpack(inner_future):
+        try:
+            result, snapshot = inner_future.result()
+        except Exception as error:
+            outer_future.set_exception(error)
+            return
+        metrics.merge(snapshot)
+        outer_future.set_result(result)
+
+    inner_future.add_done_callback(unpack)
+    return outer_future
+
+# Function to create a process pool and start all its workers right away. On Linux workers are forked, and a
+# worker forked later, from a download thread, can inherit a lock another thread holds and hang on it.
+def start_cpu_pool(cpu_workers):
+    pool = ProcessPoolExecutor(max_workers=cpu_workers)
+    list(pool.map(abs, range(cpu_workers)))
+    return pool
 
 # Helper function to print colored messages
 def print_colored(message, color=Fore.WHITE):
@@ -29,82 +211,900 @@ def print_colored(message, color=Fore.WHITE):
 CLIENT_ID = ""
 CLIENT_SECRET = ""
 
+# Base URLs of the Spotify services (the benchmarks point them at a local mock server)
+SPOTIFY_ACCOUNTS_URL = "https://accounts.spotify.com"
+SPOTIFY_API_URL = "https://api.spotify.com"
+SPOTIFY_CODES_URL = "https://scannables.scdn.co"
+
+# Requests per second allowed per host before any 429 is seen (hosts missing here are not throttled up front)
+HOST_RATE_LIMITS = {
+    "accounts.spotify.com": 2.0,
+    "api.spotify.com": 10.0,
+}
+
+# Lowest rate a host is slowed down to after repeated 429 responses
+MIN_RATE_LIMIT = 0.5
+
+# Number of retries for 429, 5xx and connection errors before a request is reported as failed
+MAX_RETRIES = 5
+
+# Base and maximum delay in seconds of the jittered exponential backoff
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 30.0
+
+# Delay used when a 429 response carries no usable Retry-After header
+DEFAULT_RETRY_AFTER = 1.0
+
+# Token bucket for one host that slows down on 429 and pauses for Retry-After
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self._tokens = rate or 0.0
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._updated_at) * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, retry_after):
+        with self._lock:
+            # Every worker waits out the server's Retry-After, then resumes at half the previous rate
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            if self.rate is not None:
+                self.rate = max(MIN_RATE_LIMIT, self.rate / 2)
+                self._tokens = 0.0
+
+    def relax(self):
+        with self._lock:
+            # Recover slowly so one 429 does not pin the rate down for the rest of the run
+            if self.rate is not None and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+# Rate-limit controller shared by every thread and task, with retry counters
+class RateLimitController:
+    def __init__(self, host_rates=None):
+        self.host_rates = dict(HOST_RATE_LIMITS if host_rates is None else host_rates)
+        self.counters = Counter()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.host_rates.get(host))
+            return self._buckets[host]
+
+    def _count(self, name, host):
+        with self._lock:
+            self.counters[name] += 1
+        metrics.add(f"http_{name}", host=host)
+
+    def send(self, session, method, url, **kwargs):
+        host = urlsplit(url).hostname
+        bucket = self._bucket(host)
+        for attempt in range(MAX_RETRIES + 1):
+            bucket.acquire()
+            self._count("requests", host)
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == MAX_RETRIES:
+                    self._count("failed", host)
+                    raise
+                self._count("retried", host)
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if response.status_code == 429:
+                self._count("throttled", host)
+                bucket.throttle(parse_retry_after(response.headers.get("Retry-After")))
+            elif response.status_code >= 500:
+                time.sleep(backoff_delay(attempt))
+            else:
+                bucket.relax()
+                return response
+
+            if attempt == MAX_RETRIES:
+                self._count("failed", host)
+                return response
+            self._count("retried", host)
+            response.close()
+
+# Function to compute the jittered exponential backoff delay of a retry
+def backoff_delay(attempt):
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+# Function to read the delay in seconds from a Retry-After header
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+rate_limiter = RateLimitController()
+
+# Number of hosts a session keeps a connection pool for
+HTTP_POOL_CONNECTIONS = 10
+
+# Connections kept open per host. None fits the pools to the threads sharing a session (NETWORK_WORKERS
+# plus PLAYLIST_PAGE_WORKERS), as requests' default of 10 makes the extra threads open and drop a connection per request.
+HTTP_POOL_MAXSIZE = None
+
+# Function to create a requests session whose connection pools fit the worker threads sharing it
+def new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE or NETWORK_WORKERS + PLAYLIST_PAGE_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Session for requests sent without one, so single requests still reuse connections
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+# Function to get the session used for requests sent without one
+def shared_session():
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = new_session()
+        return _shared_session
+
+# Function to send an HTTP request through the shared rate limiter
+def send_request(session, method, url, **kwargs):
+    return rate_limiter.send(session or shared_session(), method, url, **kwargs)
+
+# Function to print how many requests were sent, throttled, retried and lost
+def print_request_stats():
+    counters = rate_limiter.counters
+    status = "WARNING" if counters["failed"] else "INFO"
+    print_status(
+        f"Requests: {counters['requests']}, throttled: {counters['throttled']}, "
+        f"retried: {counters['retried']}, failed: {counters['failed']}",
+        status,
+    )
+
+# Stages that wait on the network and stages that keep a CPU busy, used to tell what bound a run
+NETWORK_STAGES = ("token", "metadata", "cover_download", "code_download")
+CPU_STAGES = ("color_pick", "composite", "encode")
+
+# Function to print where the run spent its time and write the metrics file
+def write_run_metrics():
+    if not metrics.enabled:
+        return
+
+    stages = metrics.snapshot()["stages"]
+    for stage, (calls, seconds, slowest) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        print_status(f"{stage:<15} {seconds:9.2f} s in {calls} calls, slowest {slowest * 1000:.0f} ms", "STATUS")
+
+    # Stages of different tracks overlap, so these are busy times, not shares of the wall clock
+    network_seconds = sum(stages.get(stage, [0, 0.0])[1] for stage in NETWORK_STAGES)
+    cpu_seconds = sum(stages.get(stage, [0, 0.0])[1] for stage in CPU_STAGES)
+    print_status(f"Network stages: {network_seconds:.2f} s, CPU stages: {cpu_seconds:.2f} s", "INFO")
+
+    if METRICS_FILE:
+        text = metrics.prometheus_text() if METRICS_FORMAT == "prometheus" else metrics.json_lines()
+        write_file_atomic(METRICS_FILE, text.encode("utf-8"))
+        print_status(f"Metrics written to {METRICS_FILE}", "INFO")
+
+# Optional path used to persist the access token between runs (None keeps it in memory only)
+TOKEN_CACHE_FILE = None
+
+# Name of the token file the command line keeps in the cache folder
+TOKEN_CACHE_FILE_NAME = "token.json"
+
+# Refresh the access token this many seconds before Spotify says it expires
+TOKEN_REFRESH_MARGIN = 60
+
+# Thread-safe access token cache shared by every worker
+class TokenManager:
+    def __init__(self, cache_file=None, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._cache_loaded = False
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+
+    def get_token(self):
+        if self._is_fresh():
+            return self._token
+
+        # Only one thread talks to the token endpoint, the others wait for its result
+        with self._lock:
+            if not self._cache_loaded:
+                self._cache_loaded = True
+                self._load_cached_token()
+            if self._is_fresh():
+                return self._token
+            return self._refresh()
+
+    def set_cache_file(self, cache_file):
+        with self._lock:
+            self.cache_file = cache_file
+            self._cache_loaded = False
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _refresh(self):
+        url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+        data = {"grant_type": "client_credentials"}
+
+        with metrics.stage("token"):
+            response = send_request(None, "POST", url, data=data, auth=(CLIENT_ID, CLIENT_SECRET))
+        if response.status_code == 200:
+            token_data = response.json()
+            self._token = token_data["access_token"]
+            self._expires_at = time.time() + token_data.get("expires_in", 3600)
+            self._save_cached_token()
+            return self._token
+        else:
+            print_status(f"Error: Unable to fetch access token. {response.json()}", "ERROR")
+            return None
+
+    def _load_cached_token(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        # Ignore tokens issued for a different application
+        if cached.get("client_id") == CLIENT_ID:
+            self._token = cached.get("access_token")
+            self._expires_at = cached.get("expires_at", 0.0)
+
+    def _save_cached_token(self):
+        if not self.cache_file:
+            return
+        cached = {"client_id": CLIENT_ID, "access_token": self._token, "expires_at": self._expires_at}
+        temp_path = f"{self.cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+            # The token is a credential, so keep the file private to the current user
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as file:
+                json.dump(cached, file)
+            # Renaming makes the new token appear at once, so a concurrent run never reads a half-written file
+            os.replace(temp_path, self.cache_file)
+        except OSError as error:
+            print_status(f"Unable to persist access token to {self.cache_file}: {error}", "WARNING")
+
+token_manager = TokenManager(TOKEN_CACHE_FILE)
+
 # Function to get Spotify API access token
 def get_access_token():
-    url = "https://accounts.spotify.com/api/token"
-    headers = {"Authorization": f"Basic {CLIENT_ID}:{CLIENT_SECRET}"}
-    data = {"grant_type": "client_credentials"}
+    return token_manager.get_token()
+
+# Maximum number of IDs accepted by the Spotify multi-track endpoint
+TRACKS_BATCH_SIZE = 50
+
+# Function to extract the Spotify ID from a URL
+def extract_spotify_id(spotify_url):
+    return spotify_url.split("/")[-1].split("?")[0]
+
+# Function to sanitize a track name into a valid filename
+def sanitize_track_name(track_name):
+    # Replace spaces and sanitize the track name to create a valid filename
+    sanitized_track_name = re.sub(r'[\s\\/*?"<>|]', "-", track_name)
+
+    # Further sanitize track name to ensure no illegal characters
+    return re.sub(r'[<>:"/\\|?*]', "-", sanitized_track_name)
+
+# Function to pick the largest album cover URL and the sanitized name from track data
+def extract_cover_info(track_data):
+    album_images = track_data["album"]["images"]
+    if not album_images:
+        return None, None
+
+    album_images.sort(key=lambda x: x['height'], reverse=True)
+    return album_images[0]["url"], sanitize_track_name(track_data["name"])
+
+# Market sent with every API request, None for none. With a market set the API leaves out the large
+# available_markets arrays, but relinks tracks unavailable there to other tracks, whose original is in linked_from.
+API_MARKET = None
+
+# Track fields the playlist flows read and the metadata store keeps: the URI, the name, the album and the relinked original
+PLAYLIST_TRACK_FIELDS = "uri,name,album(id,images),linked_from(uri)"
+
+# Fields filter of each kind of playlist request (only the playlist endpoints accept one)
+API_FIELDS = {
+    "playlist": f"name,snapshot_id,tracks(items(added_at,track({PLAYLIST_TRACK_FIELDS})),offset,total,next)",
+    "playlist_snapshot": "name,snapshot_id",
+    "playlist_items": f"items(added_at,track({PLAYLIST_TRACK_FIELDS}))",
+}
+
+# Function to build the URL and query of a Spotify API request, with its fields filter and market
+def build_api_request(path, fields=None, **params):
+    if fields:
+        params["fields"] = API_FIELDS[fields]
+    if API_MARKET:
+        params["market"] = API_MARKET
+    return f"{SPOTIFY_API_URL}{path}", params
+
+# Function to make an authorized GET request to a Spotify API path built by build_api_request
+def spotify_api_request(path, session=None, fields=None, **params):
+    url, params = build_api_request(path, fields, **params)
+    return spotify_api_get(url, params=params, session=session)
+
+# Function to make an authorized GET request to the Spotify API
+def spotify_api_get(url, params=None, session=None):
+    for attempt in range(2):
+        access_token = get_access_token()
+        if not access_token:
+            return None
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+        with metrics.stage("metadata"):
+            response = send_request(session, "GET", url, headers=headers, params=params)
+
+        # The token was revoked or expired early, so fetch a new one and retry once
+        if response.status_code == 401 and attempt == 0:
+            token_manager.invalidate()
+            continue
+        return response
+
+# File of the local metadata store, next to the image caches
+METADATA_DB_FILE = os.path.join(".spotyscan_cache", "metadata.sqlite3")
+
+# Seconds stored metadata stays fresh, per kind (playlists are also checked against their snapshot ID before use)
+METADATA_TTLS = {
+    "track": 30 * 24 * 3600,
+    "album": 30 * 24 * 3600,
+    "playlist": 7 * 24 * 3600,
+}
+
+# Largest number of IDs looked up in one query, well below SQLite's limit on query parameters
+METADATA_QUERY_CHUNK = 500
+
+# Tables of the metadata store
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY, uri TEXT NOT NULL, name TEXT NOT NULL, album_id TEXT, images TEXT NOT NULL, fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY, name TEXT, images TEXT NOT NULL, track_ids TEXT NOT NULL, fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, snapshot_id TEXT NOT NULL, items TEXT NOT NULL, fetched_at REAL NOT NULL
+);
+"""
+
+# Local SQLite store of track, album and playlist metadata keyed by Spotify ID.
+# Every thread gets its own connection, and WAL mode lets them read while another one writes.
+class MetadataStore:
+    def __init__(self, path):
+        self.path = path
+        self.enabled = True
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, "path", None) != self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(METADATA_SCHEMA)
+            self._local.connection, self._local.path = connection, self.path
+        return self._local.connection
+
+    def _disable(self, error):
+        # A broken store only costs API requests, so keep going without it
+        if self.enabled:
+            print_status(f"Metadata store {self.path} unavailable, continuing without it: {error}", "WARNING")
+        self.enabled = False
+
+    def _fresh_rows(self, table, ids, columns):
+        rows = {}
+        if not self.enabled or not ids:
+            return rows
+        cutoff = time.time() - METADATA_TTLS[table[:-1]]
+        ids = list(ids)
+        try:
+            connection = self._connection()
+            for start in range(0, len(ids), METADATA_QUERY_CHUNK):
+                chunk = ids[start:start + METADATA_QUERY_CHUNK]
+                query = f"SELECT id, {columns} FROM {table} WHERE fetched_at >= ? AND id IN ({','.join('?' * len(chunk))})"
+                for row in connection.execute(query, [cutoff, *chunk]):
+                    rows[row[0]] = row[1:]
+        except (OSError, sqlite3.Error) as error:
+            self._disable(error)
+        return rows
+
+    def _write(self, statements):
+        if not self.enabled:
+            return
+        try:
+            connection = self._connection()
+            # One transaction per bulk write
+            with connection:
+                for statement, rows in statements:
+                    connection.executemany(statement, rows)
+        except (OSError, sqlite3.Error) as error:
+            self._disable(error)
+
+    def get_tracks(self, track_ids):
+        return {
+            track_id: {"id": track_id, "uri": uri, "name": name, "album": {"id": album_id, "images": json.loads(images)}}
+            for track_id, (uri, name, album_id, images) in self._fresh_rows("tracks", track_ids, "uri, name, album_id, images").items()
+        }
+
+    def get_track(self, track_id):
+        return self.get_tracks([track_id]).get(track_id)
+
+    # Rows upserting (track ID, track data) pairs, skipping unavailable tracks
+    def _track_rows(self, tracks):
+        now = time.time()
+        return [
+            (track_id, track_uri(track), track["name"], track["album"].get("id"), json.dumps(track["album"].get("images") or []), now)
+            for track_id, track in tracks
+            if track_id and track and track.get("uri") and track.get("name") and track.get("album")
+        ]
+
+    def put_tracks(self, tracks):
+        self._write([("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)", self._track_rows(tracks))])
+
+    # Albums come back with their whole track list, and only when every track is stored too
+    def get_albums(self, album_ids):
+        albums = self._fresh_rows("albums", album_ids, "name, images, track_ids")
+        track_ids = [track_id for _, _, ids in albums.values() for track_id in json.loads(ids)]
+        tracks = self.get_tracks(track_ids)
+
+        complete = {}
+        for album_id, (name, images, ids) in albums.items():
+            ids = json.loads(ids)
+            if all(track_id in tracks for track_id in ids):
+                album = {"id": album_id, "name": name, "images": json.loads(images)}
+                complete[album_id] = [{**tracks[track_id], "album": album} for track_id in ids]
+        return complete
+
+    def put_album(self, album, tracks):
+        track_ids = [spotify_track_id(track) for track in tracks]
+        self._write([
+            ("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)", self._track_rows(zip(track_ids, tracks))),
+            ("INSERT OR REPLACE INTO albums VALUES (?, ?, ?, ?, ?)",
+             [(album["id"], album.get("name"), json.dumps(album.get("images") or []), json.dumps(track_ids), time.time())]),
+        ])
+
+    # Playlists come back as (name, snapshot ID, items), and only when every available track is stored too
+    def get_playlist(self, playlist_id):
+        row = self._fresh_rows("playlists", [playlist_id], "name, snapshot_id, items").get(playlist_id)
+        if not row:
+            return None
+        name, snapshot_id, items = row
+        items = json.loads(items)
+        tracks = self.get_tracks([track_id for track_id, _ in items if track_id])
+        if not all(track_id in tracks for track_id, _ in items if track_id):
+            return None
+        return name, snapshot_id, [{"added_at": added_at, "track": tracks.get(track_id)} for track_id, added_at in items]
+
+    def put_playlist(self, playlist_id, name, snapshot_id, items):
+        tracks = [(spotify_track_id(item["track"]), item["track"]) for item in items]
+        stored_ids = {row[0] for row in self._track_rows(tracks)}
+        entries = [(track_id if track_id in stored_ids else None, item.get("added_at")) for (track_id, _), item in zip(tracks, items)]
+        self._write([
+            ("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)", self._track_rows(tracks)),
+            ("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)", [(playlist_id, name, snapshot_id, json.dumps(entries), time.time())]),
+        ])
+
+metadata_store = MetadataStore(METADATA_DB_FILE)
+
+# Function to get the URI of the track a playlist or album lists, not the one a market relinked it to
+def track_uri(track):
+    return (track.get("linked_from") or track)["uri"]
+
+# Function to get the Spotify ID of track data, which field-filtered playlist items only carry in the URI
+def spotify_track_id(track):
+    if not track or not track.get("uri"):
+        return None
+    return track_uri(track).rsplit(":", 1)[-1]
+
+# Function to fetch track data for one chunk of IDs using the multi-track endpoint
+def fetch_tracks_chunk(session, chunk):
+    tracks = {}
+    response = spotify_api_request("/v1/tracks", session=session, ids=",".join(chunk))
+    if response is None:
+        return tracks
 
-    response = requests.post(url, data=data, auth=(CLIENT_ID, CLIENT_SECRET))
     if response.status_code == 200:
-        return response.json()["access_token"]
+        # Results come back in request order, with null for unknown IDs
+        for spotify_id, track_data in zip(chunk, response.json()["tracks"]):
+            if track_data and track_data.get("album"):
+                tracks[spotify_id] = track_data
+        metadata_store.put_tracks(tracks.items())
     else:
-        print_status(f"Error: Unable to fetch access token. {response.json()}", "ERROR")
-        return None
+        print_status(f"Error: Unable to fetch track data for {len(chunk)} tracks. {response.json()}", "ERROR")
+    return tracks
 
 # Function to fetch album cover URL
 def fetch_cover_image(spotify_url):
     # Extract the Spotify ID from the URL
-    spotify_id = spotify_url.split("/")[-1].split("?")[0]
+    spotify_id = extract_spotify_id(spotify_url)
+
+    # Tracks looked up by an earlier run come from the metadata store
+    track_data = metadata_store.get_track(spotify_id)
+    if track_data is None:
+        # Make a request to the Spotify API
+        response = spotify_api_request(f"/v1/tracks/{spotify_id}")
+        if response is None:
+            return None, None
+        if response.status_code != 200:
+            print_status(f"Error: Unable to fetch track data. {response.json()}", "ERROR")
+            return None, None
+        track_data = response.json()
+        metadata_store.put_tracks([(spotify_id, track_data)])
+
+    # Fetch the largest available album cover image
+    album_cover_url, sanitized_track_name = extract_cover_info(track_data)
+    if album_cover_url:
+        print_status(f"Fetching cover image from URL: {album_cover_url}", "INFO")
+        return album_cover_url, sanitized_track_name
+    else:
+        print_status("No images found for the track.", "WARNING")
+        return None, None
+
+# Folder used to cache downloaded cover images between runs
+COVER_CACHE_DIR = os.path.join(".spotyscan_cache", "covers")
+
+# Maximum size of the cover cache before the least recently used covers are evicted
+COVER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Folder used to cache downloaded Spotify code images between runs
+CODE_CACHE_DIR = os.path.join(".spotyscan_cache", "codes")
+
+# Maximum size of the Spotify code cache before the least recently used codes are evicted
+CODE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Only serve images from the caches and never download them (used to rebuild composites offline)
+CACHE_ONLY = False
+
+# ioctl request used to reflink a file on Linux filesystems that support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Function to check that image data is a complete JPEG or PNG file, given its first and last bytes
+def is_complete_image(head, tail, size=None):
+    if head.startswith(b"\xff\xd8"):
+        return tail.endswith(b"\xff\xd9")
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return tail.endswith(b"IEND\xaeB`\x82")
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        # WebP has no end marker, but the RIFF header carries the size of the rest of the file
+        return size is None or int.from_bytes(head[4:8], "little") + 8 == size
+    return False
+
+# Function to check that a cached image file is complete without reading all of it
+def is_complete_image_file(path):
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as file:
+            head = file.read(12)
+            file.seek(max(0, size - 8))
+            return is_complete_image(head, file.read(), size)
+    except OSError:
+        return False
+
+# Function to build the cache key of a cover image URL
+def cover_cache_key(album_cover_url):
+    # i.scdn.co URLs end with the content hash of the image, e.g. /image/ab67616d0000b273...
+    image_hash = album_cover_url.split("?")[0].rstrip("/").split("/")[-1]
+    if "i.scdn.co" in album_cover_url and re.fullmatch(r"[0-9A-Za-z]+", image_hash):
+        return image_hash
+    return hashlib.sha1(album_cover_url.encode("utf-8")).hexdigest()
+
+# On-disk cache of downloaded images with validation and LRU eviction
+class ImageCache:
+    def __init__(self, name, cache_dir, max_bytes):
+        self.name = name
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._total_bytes = None
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    # Returns the path of a valid cached entry, called with the key's lock held
+    def _lookup(self, key):
+        cached_path = self._path(key)
+        if not os.path.exists(cached_path):
+            return None
+        if not is_complete_image_file(cached_path):
+            print_status(f"Discarding damaged cache entry {cached_path}", "WARNING")
+            os.remove(cached_path)
+            return None
+
+        # Bump the modification time so eviction treats the image as recently used
+        os.utime(cached_path)
+        metrics.add("cache_hits", cache=self.name)
+        return cached_path
+
+    def fetch_key(self, session, key, url):
+        cached_path = self._path(key)
+
+        # Concurrent requests for the same image wait for the first download instead of repeating it
+        with self._key_lock(key):
+            if self._lookup(key):
+                return cached_path
+
+            if CACHE_ONLY:
+                return None
+
+            metrics.add("cache_misses", cache=self.name)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with metrics.stage(f"{self.name}_download"):
+                image_size = download_image_file(session, url, cached_path)
+            if image_size is None:
+                return None
+
+        self._track_size(image_size, keep_path=cached_path)
+        return cached_path
+
+    # Returns the cached bytes of a key without downloading anything
+    def load(self, key):
+        with self._key_lock(key):
+            cached_path = self._lookup(key)
+            if cached_path is None:
+                metrics.add("cache_misses", cache=self.name)
+                return None
+            with open(cached_path, "rb") as file:
+                return file.read()
+
+    # Adds image bytes produced locally rather than downloaded
+    def store(self, key, data):
+        cached_path = self._path(key)
+        with self._key_lock(key):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_file_atomic(cached_path, data)
+        self._track_size(len(data), keep_path=cached_path)
+
+    def read_key(self, session, key, url):
+        cached_path = self.fetch_key(session, key, url)
+        if cached_path is None:
+            return None
+        with open(cached_path, "rb") as file:
+            return file.read()
+
+    def _track_size(self, added_bytes, keep_path):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+            else:
+                self._total_bytes += added_bytes
+            if self._total_bytes > self.max_bytes:
+                self._evict(keep_path)
+
+    def _evict(self, keep_path):
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.endswith(".jpg")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            if os.path.abspath(entry.path) == os.path.abspath(keep_path):
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._total_bytes -= size
+            except OSError:
+                pass
+
+# Content-addressed cache of cover images, keyed by the image hash in the CDN URL
+class CoverCache(ImageCache):
+    def __init__(self, cache_dir, max_bytes=COVER_CACHE_MAX_BYTES):
+        super().__init__("cover", cache_dir, max_bytes)
+
+    def fetch(self, session, album_cover_url):
+        return self.fetch_key(session, cover_cache_key(album_cover_url), album_cover_url)
+
+    def read(self, session, album_cover_url):
+        return self.read_key(session, cover_cache_key(album_cover_url), album_cover_url)
+
+# Cache of Spotify code images, keyed by everything that changes how the code looks
+class CodeCache(ImageCache):
+    def __init__(self, cache_dir, max_bytes=CODE_CACHE_MAX_BYTES):
+        super().__init__("code", cache_dir, max_bytes)
+
+    def read(self, session, spotify_uri, background_color, bar_color, size, url):
+        key = f"{spotify_uri.replace(':', '_')}_{background_color}_{bar_color}_{size}"
+        return self.read_key(session, key, url)
+
+cover_cache = CoverCache(COVER_CACHE_DIR)
+code_cache = CodeCache(CODE_CACHE_DIR)
+
+# Function to write a file through a temporary file, so readers never see it half-written
+def write_file_atomic(output_path, data):
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, output_path)
+
+# Size of the chunks downloads are written to disk in
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Number of times a truncated download is started over before giving up
+DOWNLOAD_RETRIES = 3
+
+# Function to stream one download into a file, returning the number of bytes written or None if it was cut short
+def stream_response_to_file(response, output_path):
+    received = 0
+    try:
+        with open(output_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                received += len(chunk)
+    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+        return None
 
-    # Get the access token
-    access_token = get_access_token()
-    if not access_token:
+    # Content-Length counts the encoded body, so it can only be checked when the body is sent as is
+    expected = response.headers.get("Content-Length")
+    if expected and expected.isdigit() and not response.headers.get("Content-Encoding") and int(expected) != received:
         return None
+    return received
+
+# Function to download an image to output_path in chunks through a temporary file, retrying truncated transfers
+def download_image_file(session, url, output_path):
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        with send_request(session, "GET", url, stream=True) as response:
+            if response.status_code != 200:
+                return None
+            received = stream_response_to_file(response, temp_path)
+
+        # Never keep an error page or a truncated transfer
+        if received is not None and is_complete_image_file(temp_path):
+            os.replace(temp_path, output_path)
+            metrics.add("downloaded_bytes", received, host=urlsplit(url).hostname)
+            return received
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        if attempt < DOWNLOAD_RETRIES:
+            metrics.add("download_retries", host=urlsplit(url).hostname)
+            print_status(f"Download of {url} was cut short, retrying", "WARNING")
+            time.sleep(backoff_delay(attempt))
+
+    print_status(f"Received an incomplete image from {url}", "WARNING")
+    return None
+
+# Function to place a copy of a file at output_path, sharing its data on disk where possible
+def link_or_copy(source_path, output_path):
+    # Never write through an existing file, it may be a hardlink to a cached blob
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+
+    try:
+        os.link(source_path, output_path)
+        return
+    except OSError:
+        pass
 
-    # Make a request to the Spotify API
-    url = f"https://api.spotify.com/v1/tracks/{spotify_id}"
-    headers = {"Authorization": f"Bearer {access_token}"}
+    if fcntl is not None:
+        try:
+            with open(source_path, "rb") as source, open(output_path, "wb") as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return
+        except OSError:
+            os.remove(output_path)
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        track_data = response.json()
-        # Fetch the largest available album cover image
-        album_images = track_data["album"]["images"]
-        if album_images:
-            album_images.sort(key=lambda x: x['height'], reverse=True)
-            album_cover_url = album_images[0]["url"]
-            
-            track_name = track_data["name"]
-            
-            # Replace spaces and sanitize the track name to create a valid filename
-            sanitized_track_name = re.sub(r'[\s\\/*?"<>|]', "-", track_name)
-            
-            # Further sanitize track name to ensure no illegal characters
-            sanitized_track_name = re.sub(r'[<>:"/\\|?*]', "-", sanitized_track_name)
-            
-            print_status(f"Fetching cover image from URL: {album_cover_url}", "INFO")
-            
-            return album_cover_url, sanitized_track_name
-        else:
-            print_status("No images found for the track.", "WARNING")
-            return None, None
-    else:
-        print_status(f"Error: Unable to fetch track data. {response.json()}", "ERROR")
-        return None, None
+    shutil.copyfile(source_path, output_path)
+
+# Function to save a cover image through the cover cache
+def save_cover_image(session, album_cover_url, output_path):
+    cached_path = cover_cache.fetch(session, album_cover_url)
+    if cached_path is None:
+        return False
+
+    with metrics.stage("write"):
+        link_or_copy(cached_path, output_path)
+    return True
 
 # Function to download image
 def download_image(session, album_cover_url, sanitized_playlist_name, sanitized_track_name):
     # Download and save the album cover image
-    image_response = session.get(album_cover_url)
-    if image_response.status_code == 200:
-        with open(os.path.join(sanitized_playlist_name, f"{sanitized_track_name}.jpg"), "wb") as file:
-            file.write(image_response.content)
+    if save_cover_image(session, album_cover_url, os.path.join(sanitized_playlist_name, f"{sanitized_track_name}.jpg")):
         print_status(f"Image saved as {sanitized_track_name}.jpg in {sanitized_playlist_name} folder", "SUCCESS")
     else:
         print_status(f"Failed to download the cover image for {sanitized_track_name}.", "ERROR")
 
-# Function to get the most used color in an image
-def get_most_used_color(image_path):
-    if not os.path.exists(image_path):
-        print_status(f"File not found: {image_path}", "ERROR")
-        return None
+# Images with at most this many distinct colors are counted with Image.getcolors
+GETCOLORS_MAX_COLORS = 16384
 
-    with Image.open(image_path) as img:
+# Function to find the most used color of an image
+def find_most_used_color(img):
+    if img.mode != 'RGB':
         img = img.convert('RGB')
-        pixels = list(img.getdata())
-        most_common_color = Counter(pixels).most_common(1)[0][0]
-        return most_common_color
+
+    # getcolors builds the histogram in C, but gives up early on photos with many distinct colors
+    colors = img.getcolors(maxcolors=GETCOLORS_MAX_COLORS)
+    if colors is None:
+        # Pack each pixel into one 32-bit int straight from the raw buffer and count the ints,
+        # which is much cheaper than hashing a tuple per pixel
+        packed_pixels = array('I', img.convert('RGBX').tobytes())
+        packed_color = Counter(packed_pixels).most_common(1)[0][0]
+        return tuple(packed_color.to_bytes(4, sys.byteorder)[:3])
+
+    top_count = max(count for count, _ in colors)
+    candidates = [color for count, color in colors if count == top_count]
+    if len(candidates) == 1:
+        return candidates[0]
+
+    # On ties the color that appears first in the image wins, as with Counter.most_common
+    candidate_set = set(candidates)
+    for pixel in img.getdata():
+        if pixel in candidate_set:
+            return pixel
+
+# Scale of the reduced-resolution decode used by the fast color picker (2, 4 or 8)
+FAST_PICKER_SCALE = 8
+
+# Bits kept per channel (1-7) by the fast color picker before counting, None counts exact colors
+FAST_PICKER_QUANTIZE_BITS = None
+
+# Function to find the most used color from a reduced-resolution decode of an image
+def find_most_used_color_fast(img, quantize_bits=None):
+    reduced_size = (max(1, img.width // FAST_PICKER_SCALE), max(1, img.height // FAST_PICKER_SCALE))
+
+    # JPEG covers can be decoded straight at 1/2, 1/4 or 1/8 size through DCT scaling
+    if not (img.format == 'JPEG' and img.draft('RGB', reduced_size)):
+        img = img.convert('RGB').reduce(FAST_PICKER_SCALE)
+
+    quantize_bits = quantize_bits or FAST_PICKER_QUANTIZE_BITS
+    if quantize_bits:
+        # Merge near-identical shades into one bucket and report the bucket's center
+        mask = (0xff << (8 - quantize_bits)) & 0xff
+        center = 1 << (7 - quantize_bits)
+        img = img.convert('RGB').point(lambda value: (value & mask) | center)
+
+    return find_most_used_color(img)
+
+# Color pickers available for Spotify codes, "exact" matches the full-resolution result
+COLOR_PICKERS = {
+    "exact": find_most_used_color,
+    "fast": find_most_used_color_fast,
+}
+
+# Color picker used when none is given
+COLOR_PICKER = "exact"
+
+# Function to get the most used color of an encoded image held in memory
+def get_most_used_color_from_bytes(image_bytes, picker=None, quantize_bits=None):
+    picker = picker or COLOR_PICKER
+    with metrics.stage("color_pick"), Image.open(BytesIO(image_bytes)) as img:
+        # Worker processes started with spawn do not see settings made after import, so the bits come with the call
+        if picker == "fast":
+            return find_most_used_color_fast(img, quantize_bits)
+        return COLOR_PICKERS[picker](img)
 
 # Function to determine the best bar color
 def determine_best_bar_color(most_used_color):
@@ -112,67 +1112,721 @@ def determine_best_bar_color(most_used_color):
     luminance = (0.299 * most_used_color[0] + 0.587 * most_used_color[1] + 0.114 * most_used_color[2])
     return "white" if luminance < 128 else "black"
 
-# Function to download Spotify code image with color customization
-def download_custom_spotify_code_image(session, spotify_uri, output_path, background_color, bar_color):
-    url = f"https://scannables.scdn.co/uri/plain/jpeg/{background_color}/{bar_color}/640/{spotify_uri}"
-    response = session.get(url)
-    if response.status_code == 200:
-        # Ensure the output directory exists
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, "wb") as file:
-            file.write(response.content)
-        print_status(f"Spotify code saved as {output_path}", "SUCCESS")
+# Width in pixels of the Spotify code images requested from scannables.scdn.co
+SPOTIFY_CODE_SIZE = 640
+
+# Function to fetch a Spotify code image with color customization
+def fetch_spotify_code_bytes(session, spotify_uri, background_color, bar_color):
+    url = f"{SPOTIFY_CODES_URL}/uri/plain/jpeg/{background_color}/{bar_color}/{SPOTIFY_CODE_SIZE}/{spotify_uri}"
+    code_bytes = code_cache.read(session, spotify_uri, background_color, bar_color, SPOTIFY_CODE_SIZE, url)
+    if code_bytes is not None:
+        return code_bytes
     else:
         print_status(f"Failed to download Spotify code for {spotify_uri}.", "ERROR")
+        return None
+
+# How a cover and its Spotify code are laid out: "stacked" puts the code under the cover and "side_by_side"
+# next to it, padding is the border in pixels, corner_radius rounds the cover's corners, and background is the
+# hex color around them (None uses the code's own background color)
+CompositeLayout = namedtuple("CompositeLayout", ["arrangement", "padding", "corner_radius", "background"])
+
+# Layout templates selectable by name
+LAYOUT_TEMPLATES = {
+    "stacked": CompositeLayout("stacked", 0, 0, None),
+    "card": CompositeLayout("stacked", 32, 24, None),
+    "side_by_side": CompositeLayout("side_by_side", 0, 0, None),
+    "side_by_side_card": CompositeLayout("side_by_side", 32, 24, None),
+}
+
+# Layout template used for combined images
+LAYOUT = "stacked"
+
+# Composites covers and codes onto a canvas that is reused for as long as the layout's size stays the same
+class Compositor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._canvas = None
+        self._masks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._canvas is not None:
+            self._canvas.close()
+            self._canvas = None
+        self._masks.clear()
+
+    # Returns where the cover and the code go and how large the canvas is
+    def _geometry(self, layout, cover_size, code_size):
+        padding = layout.padding
+        if layout.arrangement == "side_by_side":
+            width = cover_size[0] + code_size[0] + 3 * padding
+            height = max(cover_size[1], code_size[1]) + 2 * padding
+            cover_position = (padding, (height - cover_size[1]) // 2)
+            code_position = (cover_size[0] + 2 * padding, (height - code_size[1]) // 2)
+        else:
+            width = max(cover_size[0], code_size[0]) + 2 * padding
+            height = cover_size[1] + code_size[1] + 2 * padding
+            cover_position = (padding, padding)
+            code_position = (padding, padding + cover_size[1])
+        return (width, height), cover_position, code_position
+
+    def _canvas_for(self, size):
+        if self._canvas is None or self._canvas.size != size:
+            if self._canvas is not None:
+                self._canvas.close()
+            self._canvas = Image.new("RGB", size)
+        return self._canvas
+
+    def _corner_mask(self, size, radius):
+        key = (size, radius)
+        if key not in self._masks:
+            mask = Image.new("L", size, 0)
+            ImageDraw.Draw(mask).rounded_rectangle((0, 0, size[0] - 1, size[1] - 1), radius=radius, fill=255)
+            self._masks[key] = mask
+        return self._masks[key]
+
+    @staticmethod
+    def _has_alpha(image):
+        return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+    # Pastes an image of any mode, converting it to RGB once and honoring transparency
+    def _paste(self, canvas, image, position, mask=None):
+        if image.mode == "RGB":
+            canvas.paste(image, position, mask)
+            return
+        if image.mode == "RGBA" and mask is None:
+            canvas.paste(image, position, image)
+            return
+
+        has_alpha = self._has_alpha(image)
+        with image.convert("RGBA" if has_alpha else "RGB") as converted:
+            if has_alpha:
+                alpha = converted.getchannel("A")
+                if mask is not None:
+                    alpha = ImageChops.multiply(alpha, mask)
+                canvas.paste(converted, position, alpha)
+            else:
+                canvas.paste(converted, position, mask)
+
+    # Draws the combined image; the returned canvas is reused by the next call, so encode or copy it first
+    def render(self, cover_image, code_image, layout):
+        size, cover_position, code_position = self._geometry(layout, cover_image.size, code_image.size)
+        canvas = self._canvas_for(size)
+
+        # The previous image only needs painting over where the cover and code leave gaps or let it show through
+        covered = layout.arrangement == "stacked" and not layout.padding and cover_image.width == code_image.width
+        see_through = layout.corner_radius or self._has_alpha(cover_image) or self._has_alpha(code_image)
+        if not covered or see_through:
+            if layout.background:
+                background = ImageColor.getrgb(layout.background)
+            elif code_image.mode == "RGB":
+                background = code_image.getpixel((0, 0))
+            else:
+                with code_image.crop((0, 0, 1, 1)) as corner, corner.convert("RGB") as corner_rgb:
+                    background = corner_rgb.getpixel((0, 0))
+            canvas.paste(background, (0, 0) + size)
+
+        mask = self._corner_mask(cover_image.size, layout.corner_radius) if layout.corner_radius else None
+        self._paste(canvas, cover_image, cover_position, mask)
+        self._paste(canvas, code_image, code_position)
+        return canvas
+
+    def encode(self, cover_image, code_image, layout, image_format):
+        with self._lock:
+            buffer = BytesIO()
+            with metrics.stage("composite"):
+                canvas = self.render(cover_image, code_image, layout)
+            with metrics.stage("encode"):
+                canvas.save(buffer, format=image_format)
+            return buffer.getvalue()
+
+    def save(self, cover_image, code_image, layout, output_path):
+        with self._lock:
+            self.render(cover_image, code_image, layout).save(output_path)
+
+# Each process composites with its own compositor, so worker processes reuse their canvas across tracks
+compositor = Compositor()
+
+# Function to look up a layout template by name
+def composite_layout(layout_name=None):
+    return LAYOUT_TEMPLATES[layout_name or LAYOUT]
+
+# Format combined images are encoded in
+OUTPUT_FORMAT = "JPEG"
+
+# File extension of every supported output format
+OUTPUT_EXTENSIONS = {
+    "JPEG": ".jpg",
+    "PNG": ".png",
+    "WEBP": ".webp",
+}
+
+# Function to build the file name of a combined image
+def combined_image_name(sanitized_track_name):
+    return f"{sanitized_track_name}{OUTPUT_EXTENSIONS[OUTPUT_FORMAT]}"
+
+# Function to combine cover and Spotify code images held in memory into an encoded image
+def combine_image_bytes(cover_bytes, code_bytes, image_format=None, layout_name=None):
+    image_format = image_format or OUTPUT_FORMAT
+    with Image.open(BytesIO(cover_bytes)) as cover_image, Image.open(BytesIO(code_bytes)) as code_image:
+        return compositor.encode(cover_image, code_image, composite_layout(layout_name), image_format)
+
+# Output sink writing combined images into a folder
+class FolderSink:
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, name, data):
+        output_path = os.path.join(self.folder, name)
+        with metrics.stage("write"):
+            write_file_atomic(output_path, data)
+        return output_path
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.folder, name))
+
+    def manifest_path(self):
+        return os.path.join(self.folder, MANIFEST_FILE_NAME)
+
+    def close(self):
+        pass
+
+# Output sink writing combined images into a zip archive
+class ZipSink:
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self._lock = threading.Lock()
+        # JPEGs are already compressed, so store them as they are
+        self._archive = zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED)
+
+    def write(self, name, data):
+        with metrics.stage("write"), self._lock:
+            self._archive.writestr(name, data)
+        return f"{self.archive_path}:{name}"
+
+    # Archives are rewritten on every run, so there is nothing to resume
+    def exists(self, name):
+        return False
+
+    def manifest_path(self):
+        return None
+
+    def close(self):
+        self._archive.close()
 
-# Function to combine cover and Spotify code images
-def combine_images(cover_image_path, code_image_path, output_path):
-    # Ensure the output directory exists
-    if output_path:
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+# Output sink streaming combined images to stdout, one after the other
+class StdoutSink:
+    def __init__(self):
+        global STATUS_STREAM
+        self._lock = threading.Lock()
+        # Keep status messages out of the image stream
+        STATUS_STREAM = sys.stderr
 
-    # Combine images
-    cover_image = Image.open(cover_image_path)
-    code_image = Image.open(code_image_path)
+    def write(self, name, data):
+        with metrics.stage("write"), self._lock:
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        return "stdout"
 
-    # Create a new image with space for both cover and code
-    total_height = cover_image.height + code_image.height
-    combined_image = Image.new('RGB', (cover_image.width, total_height))
+    def exists(self, name):
+        return False
 
-    # Paste the images
-    combined_image.paste(cover_image, (0, 0))
-    combined_image.paste(code_image, (0, cover_image.height))
+    def manifest_path(self):
+        return None
 
-    combined_image.save(output_path)
+    def close(self):
+        sys.stdout.buffer.flush()
+
+# Function to open the sink combined images are written to ("-" for stdout, *.zip for an archive)
+def open_output_sink(output, default_folder):
+    if output == "-":
+        return StdoutSink()
+    if output and output.lower().endswith(".zip"):
+        return ZipSink(output)
+    return FolderSink(output or default_folder)
+
+# Name of the job manifest kept in output folders
+MANIFEST_FILE_NAME = ".spotyscan_manifest.sqlite3"
+
+# Number of records read per query when walking the whole manifest
+MANIFEST_PAGE_SIZE = 1000
+
+# SQLite record of how far each track of a job got, used to resume interrupted runs. Records are looked up on
+# demand, so memory stays flat however many tracks a job has. Without a path it lives in a temporary database.
+class JobManifest:
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        # One connection shared by every thread, as a temporary database is private to its connection
+        self._connection = sqlite3.connect(path or "", timeout=30, isolation_level=None, check_same_thread=False)
+        if path:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, stage TEXT NOT NULL, fields TEXT NOT NULL)")
+
+    def _get(self, key):
+        row = self._connection.execute("SELECT fields FROM records WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get(self, key):
+        with self._lock:
+            if self._connection is None:
+                return {}
+            return self._get(key)
+
+    def is_done(self, key):
+        return self.get(key).get("stage") == "composited"
+
+    def record(self, key, stage, **fields):
+        with self._lock:
+            if self._connection is None:
+                return
+            entry = {**self._get(key), "key": key, "stage": stage, **fields}
+            self._connection.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", (key, stage, json.dumps(entry)))
+
+    # Yields every record a page at a time, so records may be written while walking them
+    def iter_records(self):
+        last_key = ""
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT key, fields FROM records WHERE key > ? ORDER BY key LIMIT ?", (last_key, MANIFEST_PAGE_SIZE)
+                ).fetchall()
+            for key, fields in rows:
+                yield key, json.loads(fields)
+            if len(rows) < MANIFEST_PAGE_SIZE:
+                return
+            last_key = rows[-1][0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+# Function to open the job manifest that belongs to an output sink
+def open_job_manifest(sink):
+    manifest_path = sink.manifest_path()
+    if manifest_path and os.path.exists(manifest_path):
+        print_status(f"Resuming from {manifest_path}", "INFO")
+
+    manifest = JobManifest(manifest_path)
+    # A track only counts as done when its output actually made it to disk
+    for key, record in manifest.iter_records():
+        if record.get("stage") == "composited" and not sink.exists(record.get("output", "")):
+            manifest.record(key, "resolved")
+    return manifest
+
+# Function to render one track's cover and Spotify code into a combined image in memory
+def render_track_with_code(session, sink, manifest, spotify_uri, album_cover_url, sanitized_track_name):
+    cover_bytes = cover_cache.read(session, album_cover_url)
+    if cover_bytes is None:
+        print_status(f"Failed to download the cover image for {sanitized_track_name}.", "ERROR")
+        manifest.record(spotify_uri, "failed", error="cover")
+        return False
+    manifest.record(spotify_uri, "cover")
+
+    # Get most used color
+    most_used_color = get_most_used_color_from_bytes(cover_bytes, COLOR_PICKER, FAST_PICKER_QUANTIZE_BITS)
+    background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
+
+    # Determine best bar color
+    bar_color = determine_best_bar_color(most_used_color)
+
+    # Download Spotify code image with custom colors
+    code_bytes = fetch_spotify_code_bytes(session, spotify_uri, background_color, bar_color)
+    if code_bytes is None:
+        manifest.record(spotify_uri, "failed", error="code")
+        return False
+    manifest.record(spotify_uri, "code")
+
+    # Combine images and write only the result
+    output_name = combined_image_name(sanitized_track_name)
+    output_path = sink.write(output_name, combine_image_bytes(cover_bytes, code_bytes))
+    manifest.record(spotify_uri, "composited", output=output_name)
     print_status(f"Combined image saved as {output_path}", "SUCCESS")
+    return True
+
+# Number of worker processes used for color picking and compositing
+CPU_WORKERS = os.cpu_count() or 1
+
+# Number of threads used for cover and code downloads in the image pipeline
+NETWORK_WORKERS = 16
+
+# Maximum number of tracks inside the image pipeline at once
+PIPELINE_MAX_IN_FLIGHT = 64
+
+# One track moving through the image pipeline
+CodeJob = namedtuple("CodeJob", ["spotify_uri", "album_cover_url", "name"])
+
+# Staged pipeline that downloads on threads and runs Pillow work in worker processes
+class CodePipeline:
+    def __init__(self, session, sink, manifest=None, cpu_workers=None, network_workers=None, max_in_flight=None):
+        self.session = session
+        self.sink = sink
+        self.manifest = manifest or JobManifest()
+        self.completed = 0
+        self.failed = 0
+        self._cpu_pool = start_cpu_pool(cpu_workers or CPU_WORKERS)
+        self._network_pool = ThreadPoolExecutor(max_workers=network_workers or NETWORK_WORKERS)
+        # Each job holds a slot until it leaves the last stage, so a fast producer blocks
+        # instead of queueing thousands of tracks in front of a slow stage
+        self._slots = threading.BoundedSemaphore(max_in_flight or PIPELINE_MAX_IN_FLIGHT)
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, job):
+        self._slots.acquire()
+        with self._idle:
+            self._in_flight += 1
+
+        # Stage 1 (network): fetch the cover bytes through the cover cache
+        try:
+            future = self._network_pool.submit(cover_cache.read, self.session, job.album_cover_url)
+        except Exception as error:
+            print_status(f"Failed to start the cover download for {job.name}: {error}", "ERROR")
+            return self._finish(job, "cover")
+        self._then(job, "color", future, self._after_cover)
+
+    def close(self):
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight == 0)
+        self._network_pool.shutdown()
+        self._cpu_pool.shutdown()
+
+    def _then(self, job, next_stage, future, callback):
+        # A stage callback that raises, e.g. because a worker process died and the process pool is broken,
+        # fails the job instead of leaving it in flight, as close() waits for every job to finish
+        def run(future):
+            try:
+                callback(job, future)
+            except Exception as error:
+                print_status(f"Failed to start the {next_stage} stage for {job.name}: {error}", "ERROR")
+                self._finish(job, next_stage)
+        future.add_done_callback(run)
+
+    def _result(self, job, future, error_message):
+        try:
+            result = future.result()
+        except Exception as error:
+            print_status(f"{error_message} for {job.name}: {error}", "ERROR")
+            return None
+        if result is None:
+            print_status(f"{error_message} for {job.name}.", "ERROR")
+        return result
+
+    def _after_cover(self, job, future):
+        cover_bytes = self._result(job, future, "Failed to download the cover image")
+        if cover_bytes is None:
+            return self._finish(job, "cover")
+        self.manifest.record(job.spotify_uri, "cover")
+
+        # Stage 2 (CPU): pick the most used color in a worker process
+        future = submit_cpu_work(self._cpu_pool, get_most_used_color_from_bytes, cover_bytes, COLOR_PICKER, FAST_PICKER_QUANTIZE_BITS)
+        self._then(job, "code", future, partial(self._after_color, cover_bytes=cover_bytes))
+
+    def _after_color(self, job, future, cover_bytes):
+        most_used_color = self._result(job, future, "Failed to pick the most used color")
+        if most_used_color is None:
+            return self._finish(job, "color")
+
+        background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
+        bar_color = determine_best_bar_color(most_used_color)
+
+        # Stage 3 (network): download the Spotify code with the picked colors
+        future = self._network_pool.submit(fetch_spotify_code_bytes, self.session, job.spotify_uri, background_color, bar_color)
+        self._then(job, "composite", future, partial(self._after_code, cover_bytes=cover_bytes))
+
+    def _after_code(self, job, future, cover_bytes):
+        code_bytes = self._result(job, future, "Failed to download the Spotify code")
+        if code_bytes is None:
+            return self._finish(job, "code")
+        self.manifest.record(job.spotify_uri, "code")
+
+        # Stage 4 (CPU): composite and encode the combined image in a worker process
+        future = submit_cpu_work(self._cpu_pool, combine_image_bytes, cover_bytes, code_bytes, OUTPUT_FORMAT, LAYOUT)
+        self._then(job, "write", future, self._after_combine)
+
+    def _after_combine(self, job, future):
+        combined_bytes = self._result(job, future, "Failed to combine images")
+        if combined_bytes is None:
+            return self._finish(job, "composite")
+
+        # Stage 5 (I/O): hand the encoded image to the sink, off the process pool's result thread
+        future = self._network_pool.submit(self.sink.write, combined_image_name(job.name), combined_bytes)
+        self._then(job, "write", future, self._after_write)
+
+    def _after_write(self, job, future):
+        output_path = self._result(job, future, "Failed to write the combined image")
+        if output_path is None:
+            return self._finish(job, "write")
+
+        self.manifest.record(job.spotify_uri, "composited", output=combined_image_name(job.name))
+        print_status(f"Combined image saved as {output_path}", "SUCCESS")
+        self._finish(job, None)
+
+    def _finish(self, job, failed_stage):
+        succeeded = failed_stage is None
+        if not succeeded:
+            try:
+                self.manifest.record(job.spotify_uri, "failed", error=failed_stage)
+            except Exception as error:
+                print_status(f"Failed to record the failure of {job.name}: {error}", "ERROR")
+
+        with self._idle:
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._in_flight -= 1
+            self._idle.notify_all()
+        self._slots.release()
+
+# HTTP engine used by the link-file modes: "sync" sends one request at a time, "async" overlaps them
+HTTP_ENGINE = "sync"
+
+# Maximum concurrent requests per host for the async engine
+HOST_CONCURRENCY = {
+    "api.spotify.com": 4,
+    "i.scdn.co": 16,
+    "scannables.scdn.co": 16,
+}
+
+# Maximum concurrent requests for hosts missing from HOST_CONCURRENCY
+DEFAULT_HOST_CONCURRENCY = 4
+
+# Session that caps concurrent requests per host and keeps a connection pool large enough for the cap
+# (HTTP_POOL_MAXSIZE overrides the pool size of every host)
+class HostLimitedSession(requests.Session):
+    def __init__(self, host_concurrency=None):
+        super().__init__()
+        self.host_concurrency = dict(HOST_CONCURRENCY if host_concurrency is None else host_concurrency)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE or DEFAULT_HOST_CONCURRENCY)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        for host, limit in self.host_concurrency.items():
+            for scheme in ("https", "http"):
+                self.mount(f"{scheme}://{host}", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE or limit))
+
+    def _slots(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                limit = self.host_concurrency.get(host, DEFAULT_HOST_CONCURRENCY)
+                self._host_slots[host] = threading.BoundedSemaphore(limit)
+            return self._host_slots[host]
+
+    def request(self, method, url, *args, **kwargs):
+        with self._slots(urlsplit(url).hostname):
+            return super().request(method, url, *args, **kwargs)
+
+# asyncio engine that overlaps requests on pooled connections and runs Pillow work in worker processes
+class AsyncEngine:
+    def __init__(self, cpu_workers=None, max_in_flight=None):
+        # The worker processes start before the I/O threads exist
+        self._cpu_pool = start_cpu_pool(cpu_workers or CPU_WORKERS)
+        self.session = HostLimitedSession()
+        self.max_in_flight = max_in_flight or PIPELINE_MAX_IN_FLIGHT
+        # requests is blocking, so every request gets an I/O thread and the host caps do the limiting
+        io_workers = sum(self.session.host_concurrency.values()) + DEFAULT_HOST_CONCURRENCY
+        self._io_pool = ThreadPoolExecutor(max_workers=io_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._io_pool.shutdown()
+        self._cpu_pool.shutdown()
+        self.session.close()
+
+    async def io(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io_pool, partial(function, *args))
+
+    async def cpu(self, function, *args):
+        return await asyncio.wrap_future(submit_cpu_work(self._cpu_pool, function, *args))
+
+    async def run_stream(self, items, render):
+        # Items are pulled one at a time on a worker thread, producing them may block on the network,
+        # and no more are pulled while max_in_flight renders are running
+        running = set()
+        while True:
+            item = await self.io(next, items, None)
+            if item is None:
+                break
+            running.add(asyncio.ensure_future(render(*item)))
+            if len(running) >= self.max_in_flight:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+
+        for task in asyncio.as_completed(running):
+            await task
+
+# Function to render one track's cover and Spotify code on the async engine.
+# Like the sync pipeline, a failing track is recorded as failed and never aborts the other tracks.
+async def render_track_with_code_async(engine, sink, manifest, spotify_uri, album_cover_url, sanitized_track_name):
+    stage = "cover"
+    try:
+        cover_bytes = await engine.io(cover_cache.read, engine.session, album_cover_url)
+        if cover_bytes is None:
+            print_status(f"Failed to download the cover image for {sanitized_track_name}.", "ERROR")
+            manifest.record(spotify_uri, "failed", error=stage)
+            return False
+        manifest.record(spotify_uri, "cover")
+
+        stage = "color"
+        most_used_color = await engine.cpu(get_most_used_color_from_bytes, cover_bytes, COLOR_PICKER, FAST_PICKER_QUANTIZE_BITS)
+        background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
+        bar_color = determine_best_bar_color(most_used_color)
+
+        stage = "code"
+        code_bytes = await engine.io(fetch_spotify_code_bytes, engine.session, spotify_uri, background_color, bar_color)
+        if code_bytes is None:
+            manifest.record(spotify_uri, "failed", error=stage)
+            return False
+        manifest.record(spotify_uri, "code")
+
+        stage = "composite"
+        output_name = combined_image_name(sanitized_track_name)
+        combined_bytes = await engine.cpu(combine_image_bytes, cover_bytes, code_bytes, OUTPUT_FORMAT, LAYOUT)
+        stage = "write"
+        output_path = await engine.io(sink.write, output_name, combined_bytes)
+        manifest.record(spotify_uri, "composited", output=output_name)
+    except Exception as error:
+        print_status(f"Failed at the {stage} stage for {sanitized_track_name}: {error}", "ERROR")
+        manifest.record(spotify_uri, "failed", error=stage)
+        return False
 
-# Function to fetch playlist details and download cover images for all tracks
-def download_playlist_images(playlist_url):
-    # Extract the Spotify ID from the URL
-    playlist_id = playlist_url.split("/")[-1].split("?")[0]
+    print_status(f"Combined image saved as {output_path}", "SUCCESS")
+    return True
+
+# Function to download the covers of a stream of links on the async engine
+async def download_song_links_async(spotify_links, output_folder_name):
+    with AsyncEngine() as engine:
+        link_tracks = iter_link_tracks(engine.session, spotify_links)
+        await engine.run_stream(link_tracks, partial(save_link_cover_async, engine, output_folder_name))
+
+# Function to save the cover of one link-file track on the async engine
+async def save_link_cover_async(engine, output_folder_name, spotify_uri, album_cover_url, sanitized_track_name):
+    try:
+        await engine.io(save_link_cover, engine.session, output_folder_name, album_cover_url, sanitized_track_name)
+    except Exception as error:
+        print_status(f"Failed to save the cover image for {sanitized_track_name}: {error}", "ERROR")
+
+# Function to render the covers and Spotify codes of a stream of links on the async engine
+async def render_song_links_async(spotify_links, sink, manifest):
+    with AsyncEngine() as engine:
+        link_tracks = iter_link_tracks(engine.session, spotify_links, partial(manifest_track_info, manifest))
+        await engine.run_stream(
+            iter_pending_link_tracks(link_tracks, manifest),
+            partial(render_track_with_code_async, engine, sink, manifest),
+        )
+
+# Number of playlist items requested per page (the API maximum)
+PLAYLIST_PAGE_SIZE = 100
+
+# Number of playlist pages fetched concurrently
+PLAYLIST_PAGE_WORKERS = 4
+
+# Function to fetch one page of playlist items
+def fetch_playlist_page(session, playlist_id, offset):
+    response = spotify_api_request(f"/v1/playlists/{playlist_id}/tracks", session=session, fields="playlist_items",
+                                   offset=offset, limit=PLAYLIST_PAGE_SIZE)
+    if response is not None and response.status_code == 200:
+        return response.json()["items"]
+
+    print_status(f"Error: Unable to fetch playlist items at offset {offset}.", "ERROR")
+    return []
+
+# Function to iterate over every playlist item, fetching the remaining pages in parallel
+def iter_playlist_items(session, playlist_id, playlist_data):
+    first_page = playlist_data["tracks"]
+    items = list(first_page["items"])
+    yield from first_page["items"]
+
+    # The first page tells us how many items exist, so every other page can be requested at once
+    next_offset = first_page.get("offset", 0) + len(first_page["items"])
+    offsets = range(next_offset, first_page.get("total", 0), PLAYLIST_PAGE_SIZE)
+    if first_page.get("next") and offsets:
+        executor = ThreadPoolExecutor(max_workers=PLAYLIST_PAGE_WORKERS)
+        try:
+            futures = [executor.submit(fetch_playlist_page, session, playlist_id, offset) for offset in offsets]
+            # Yield tracks as soon as their page arrives so downloads can start early
+            for future in as_completed(futures):
+                page_items = future.result()
+                items.extend(page_items)
+                yield from page_items
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    # Store the playlist once every item arrived, unless it came from the store in the first place
+    if not playlist_data.get("from_store") and playlist_data.get("snapshot_id") and len(items) == first_page.get("total", len(items)):
+        metadata_store.put_playlist(playlist_id, playlist_data["name"], playlist_data["snapshot_id"], items)
+
+# Function to rebuild playlist details from the metadata store, if the stored snapshot is still current
+def load_stored_playlist(playlist_id):
+    stored = metadata_store.get_playlist(playlist_id)
+    if not stored:
+        return None
+    _, snapshot_id, items = stored
 
-    # Get the access token
-    access_token = get_access_token()
-    if not access_token:
+    # The snapshot ID changes whenever the playlist does, so one tiny request tells whether the stored items are current
+    snapshot = fetch_playlist(playlist_id, fields="playlist_snapshot")
+    if not snapshot or snapshot["snapshot_id"] != snapshot_id:
         return None
+    tracks = {"items": items, "offset": 0, "total": len(items), "next": None}
+    return {"name": snapshot["name"], "snapshot_id": snapshot_id, "tracks": tracks, "from_store": True}
+
+# Function to fetch playlist details, with the first page of items unless the API_FIELDS entry leaves them out
+def fetch_playlist(playlist_id, fields="playlist"):
+    if fields == "playlist":
+        stored_playlist = load_stored_playlist(playlist_id)
+        if stored_playlist:
+            return stored_playlist
 
     # Make a request to the Spotify API to get playlist details
-    url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
-    headers = {"Authorization": f"Bearer {access_token}"}
+    response = spotify_api_request(f"/v1/playlists/{playlist_id}", fields=fields)
+    if response is None:
+        return None
 
-    response = requests.get(url, headers=headers)
     if response.status_code == 200:
-        playlist_data = response.json()
+        return response.json()
+    else:
+        print_status(f"Error: Unable to fetch playlist data. {response.json()}", "ERROR")
+        return None
+
+# Function to fetch playlist details and download cover images for all tracks
+def download_playlist_images(playlist_url):
+    # Extract the Spotify ID from the URL
+    playlist_id = extract_spotify_id(playlist_url)
+
+    playlist_data = fetch_playlist(playlist_id)
+    if playlist_data:
         playlist_name = playlist_data["name"]
 
         # Sanitize playlist name for directory
         sanitized_playlist_name = re.sub(r'[\s\\/*?"<>|]', "-", playlist_name)
         os.makedirs(sanitized_playlist_name, exist_ok=True)
 
-        with requests.Session() as session:
+        all_items = []
+        with new_session() as session:
             with ThreadPoolExecutor(max_workers=5) as executor:
                 # Iterate over tracks in the playlist
-                for item in playlist_data["tracks"]["items"]:
+                for item in iter_playlist_items(session, playlist_id, playlist_data):
+                    all_items.append(item)
                     track = item["track"]
                     if not track or not track.get("album") or not track.get("name"):
                         print_status("Skipping unavailable track.", "WARNING")
@@ -185,28 +1839,28 @@ def download_playlist_images(playlist_url):
                         album_cover_url = album_images[0]["url"]
 
                         # Sanitize track name for filename
-                        sanitized_track_name = re.sub(r'[\s\\/*?"<>|]', "-", track_name)
-                        sanitized_track_name = re.sub(r'[<>:"/\\|?*]', "-", sanitized_track_name)
+                        sanitized_track_name = sanitize_track_name(track_name)
 
                         # Submit download task to the executor
                         executor.submit(download_image, session, album_cover_url, sanitized_playlist_name, sanitized_track_name)
                     else:
                         print_status(f"No images found for {track_name}.", "WARNING")
+
+        # Expose every page to callers, not just the first one
+        playlist_data["tracks"]["items"] = all_items
         return playlist_data
     else:
-        print_status(f"Error: Unable to fetch playlist data. {response.json()}", "ERROR")
         return None
 
 def fetch_track_name(spotify_id):
-    access_token = get_access_token()
-    if not access_token:
-        return "Unknown Track"
+    track_data = metadata_store.get_track(spotify_id)
+    if track_data:
+        return track_data["name"]
 
-    url = f"https://api.spotify.com/v1/tracks/{spotify_id}"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
+    response = spotify_api_request(f"/v1/tracks/{spotify_id}")
+    if response is not None and response.status_code == 200:
         track_data = response.json()
+        metadata_store.put_tracks([(spotify_id, track_data)])
         return track_data.get("name", "Unknown Track")
     else:
         return "Unknown Track"
@@ -216,11 +1870,8 @@ def process_single_song(spotify_url):
 
     if album_cover_url:
         print_status(f"Cover Image URL: {album_cover_url}", "INFO")
-        with requests.Session() as session:
-            image_response = session.get(album_cover_url)
-            if image_response.status_code == 200:
-                with open(f"{sanitized_track_name}.jpg", "wb") as file:
-                    file.write(image_response.content)
+        with new_session() as session:
+            if save_cover_image(session, album_cover_url, f"{sanitized_track_name}.jpg"):
                 print_status(f"Cover image saved as {sanitized_track_name}.jpg", "SUCCESS")
             else:
                 print_status("Failed to download the cover image.", "ERROR")
@@ -230,208 +1881,821 @@ def process_single_song(spotify_url):
 def process_playlist(playlist_url):
     download_playlist_images(playlist_url)
 
-def process_song_links_from_file(file_path):
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    output_folder_name = os.path.splitext(os.path.basename(file_path))[0]
-    os.makedirs(output_folder_name, exist_ok=True)
-
-    for line in lines:
-        spotify_url = line.strip()
-        if spotify_url:
-            album_cover_url, sanitized_track_name = fetch_cover_image(spotify_url)
-            if album_cover_url:
-                with requests.Session() as session:
-                    image_response = session.get(album_cover_url)
-                    if image_response.status_code == 200:
-                        with open(os.path.join(output_folder_name, f"{sanitized_track_name}.jpg"), "wb") as file:
-                            file.write(image_response.content)
-                        print_status(f"Cover image saved as {sanitized_track_name}.jpg in {output_folder_name}", "SUCCESS")
-                    else:
-                        print_status(f"Failed to download the cover image for {sanitized_track_name}.", "ERROR")
-            else:
-                print_status(f"Failed to fetch the cover image URL for {spotify_url}.", "ERROR")
-
-def process_single_song_with_code(spotify_url):
-    album_cover_url, sanitized_track_name = fetch_cover_image(spotify_url)
-
-    if album_cover_url:
-        print_status(f"Cover Image URL: {album_cover_url}", "INFO")
-        with requests.Session() as session:
-            image_response = session.get(album_cover_url)
-            if image_response.status_code == 200:
-                with open(f"{sanitized_track_name}.jpg", "wb") as file:
-                    file.write(image_response.content)
-                print_status(f"Cover image saved as {sanitized_track_name}.jpg", "SUCCESS")
-            else:
-                print_status("Failed to download the cover image.", "ERROR")
+# Function to save the cover of one link-file track into a folder
+def save_link_cover(session, output_folder_name, album_cover_url, sanitized_track_name):
+    if save_cover_image(session, album_cover_url, os.path.join(output_folder_name, f"{sanitized_track_name}.jpg")):
+        print_status(f"Cover image saved as {sanitized_track_name}.jpg in {output_folder_name}", "SUCCESS")
     else:
-        print_status("Failed to fetch the cover image URL.", "ERROR")
-
-    # Extract the Spotify ID from the URL
-    spotify_id = spotify_url.split("/")[-1].split("?")[0]
+        print_status(f"Failed to download the cover image for {sanitized_track_name}.", "ERROR")
 
-    # Get most used color
-    most_used_color = get_most_used_color(f"{sanitized_track_name}.jpg")
-    if most_used_color is None:
-        print_status(f"Skipping {sanitized_track_name} due to missing cover image.", "WARNING")
+# Spotify track, album, artist and playlist links, as open.spotify.com URLs or spotify: URIs
+SPOTIFY_LINK_PATTERN = re.compile(r"(?:open\.spotify\.com/(?:intl-[\w-]+/)?|spotify:)(track|album|artist|playlist)[/:]([0-9A-Za-z]+)")
+
+# Function to split a link into its kind ("track", "album", "artist" or "playlist") and Spotify ID
+def parse_spotify_link(link):
+    match = SPOTIFY_LINK_PATTERN.search(link)
+    if match:
+        return match.group(1), match.group(2)
+    # Anything else is treated as a track link, like before links of other kinds were supported
+    return "track", extract_spotify_id(link)
+
+# Spotify IDs are 22 base62 characters, and the multi-item endpoints reject a whole batch over one malformed ID
+SPOTIFY_ID_PATTERN = re.compile(r"[0-9A-Za-z]{22}")
+
+# Function to read the links of a link file lazily, one line at a time ("-" reads them from stdin)
+def iter_song_links(file_path):
+    if file_path == "-":
+        for line in sys.stdin:
+            if line.strip():
+                yield line.strip()
         return
 
-    background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
-
-    # Determine best bar color
-    bar_color = determine_best_bar_color(most_used_color)
-
-    # Download Spotify code image with custom colors
-    spotify_uri = f"spotify:track:{spotify_id}"
-    code_output_path = os.path.join("Spotify_Codes", f"{spotify_id}_code.png")
-    download_custom_spotify_code_image(session, spotify_uri, code_output_path, background_color, bar_color)
-
-    # Combine images
-    cover_image_path = f"{sanitized_track_name}.jpg"
-    combined_output_path = os.path.join("Combined_Images", f"{sanitized_track_name}.jpg")
-    combine_images(cover_image_path, code_output_path, combined_output_path)
-
-    # Clean up individual images after combining
-    os.remove(cover_image_path)
-    os.remove(code_output_path)
-
-def process_playlist_with_code(playlist_url):
-    playlist_data = download_playlist_images(playlist_url)
-
-    # Ensure playlist_data is returned and valid
+    with open(file_path, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield line.strip()
+
+# Function to name the output folder of a link file after the file
+def song_links_folder_name(file_path):
+    if file_path == "-":
+        return "Song_Links"
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+# Set of strings stored as 64-bit fingerprints in one flat array, about 16 bytes per entry
+class SeenSet:
+    def __init__(self, capacity=1 << 16):
+        self._slots = array("Q", bytes(8 * capacity))
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, key):
+        # Returns False when the key was already added
+        fingerprint = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+        if not self._insert(fingerprint):
+            return False
+
+        self._count += 1
+        if self._count * 2 > len(self._slots):
+            self._grow()
+        return True
+
+    def _insert(self, fingerprint):
+        mask = len(self._slots) - 1
+        index = fingerprint & mask
+        while self._slots[index]:
+            if self._slots[index] == fingerprint:
+                return False
+            index = (index + 1) & mask
+        self._slots[index] = fingerprint
+        return True
+
+    def _grow(self):
+        old_slots = self._slots
+        self._slots = array("Q", bytes(16 * len(old_slots)))
+        for fingerprint in old_slots:
+            if fingerprint:
+                self._insert(fingerprint)
+
+# Number of albums requested per call to the multi-album endpoint (the API maximum)
+ALBUMS_BATCH_SIZE = 20
+
+# Album groups an artist link expands to (appears_on and compilation albums mostly belong to other artists)
+ARTIST_ALBUM_GROUPS = "album,single"
+
+# Number of albums requested per page of an artist's discography (the API maximum)
+ARTIST_ALBUMS_PAGE_SIZE = 50
+
+# Function to fetch up to ALBUMS_BATCH_SIZE albums with the multi-album endpoint
+def fetch_albums_chunk(session, album_ids):
+    response = spotify_api_request("/v1/albums", session=session, ids=",".join(album_ids))
+    if response is None or response.status_code != 200:
+        print_status(f"Error: Unable to fetch {len(album_ids)} albums.", "ERROR")
+        return []
+    # Unknown IDs come back as null
+    return [album for album in response.json()["albums"] if album]
+
+# Function to iterate over every track of an album with the album attached, following its track pages
+def iter_album_page_tracks(session, album):
+    page = album.pop("tracks")
+    tracks = []
+    while True:
+        for track in page["items"]:
+            tracks.append({**track, "album": album})
+            yield tracks[-1]
+        if not page.get("next"):
+            break
+        response = spotify_api_get(page["next"], session=session)
+        if response is None or response.status_code != 200:
+            print_status(f"Error: Unable to fetch the tracks of album {album.get('id')}.", "ERROR")
+            return
+        page = response.json()
+
+    # Only complete track lists are stored
+    metadata_store.put_album(album, tracks)
+
+# Function to iterate over the tracks of many albums, taking stored albums from the metadata store
+# and looking the others up ALBUMS_BATCH_SIZE at a time
+def iter_albums_tracks(session, album_ids):
+    cached_albums = metadata_store.get_albums(album_ids)
+    for tracks in cached_albums.values():
+        yield from tracks
+
+    missing_ids = [album_id for album_id in album_ids if album_id not in cached_albums]
+    for start in range(0, len(missing_ids), ALBUMS_BATCH_SIZE):
+        for album in fetch_albums_chunk(session, missing_ids[start:start + ALBUMS_BATCH_SIZE]):
+            yield from iter_album_page_tracks(session, album)
+
+# Function to iterate over the IDs of an artist's albums
+def iter_artist_album_ids(session, artist_id):
+    url, params = build_api_request(f"/v1/artists/{artist_id}/albums", include_groups=ARTIST_ALBUM_GROUPS, limit=ARTIST_ALBUMS_PAGE_SIZE)
+    while url:
+        response = spotify_api_get(url, params=params, session=session)
+        if response is None or response.status_code != 200:
+            print_status(f"Error: Unable to fetch the albums of artist {artist_id}.", "ERROR")
+            return
+        page = response.json()
+        for album in page["items"]:
+            yield album["id"]
+        # The next URL already carries the query
+        url, params = page.get("next"), None
+
+# Function to iterate over the tracks of a playlist
+def iter_playlist_tracks(session, playlist_id):
+    playlist_data = fetch_playlist(playlist_id)
     if not playlist_data:
-        print_status("Failed to fetch playlist data.", "ERROR")
-    else:
-        # Download Spotify codes and combine images
-        with requests.Session() as session:
-            sanitized_playlist_name = re.sub(r'[\s\\/*?"<>|]', "-", playlist_data["name"])
-            for item in playlist_data["tracks"]["items"]:
-                track = item["track"]
-                if not track or not track.get("album") or not track.get("name"):
-                    print_status("Skipping unavailable track.", "WARNING")
-                    continue
+        print_status(f"Failed to fetch playlist data for {playlist_id}.", "ERROR")
+        return
+    for item in iter_playlist_items(session, playlist_id, playlist_data):
+        yield item["track"]
 
-                track_name = track["name"]
-                spotify_uri = track["uri"]
+# Function to pass on the tracks that have a cover and were not seen before as (uri, cover URL, name)
+def iter_unique_cover_tracks(tracks, seen):
+    for track in tracks:
+        if not track or not track.get("uri") or not track.get("album") or not seen.add(track_uri(track)):
+            continue
+        album_cover_url, sanitized_track_name = extract_cover_info(track)
+        if album_cover_url:
+            yield track_uri(track), album_cover_url, sanitized_track_name
+        else:
+            print_status(f"No images found for {track.get('name')}.", "WARNING")
+
+# Function to look up a batch of track links and yield the ones that have a cover
+def resolve_track_links(session, pending_links):
+    tracks = fetch_tracks_chunk(session, list(pending_links))
+    for spotify_id, link in pending_links.items():
+        album_cover_url, sanitized_track_name = extract_cover_info(tracks[spotify_id]) if spotify_id in tracks else (None, None)
+        if album_cover_url:
+            yield f"spotify:track:{spotify_id}", album_cover_url, sanitized_track_name
+        else:
+            print_status(f"Failed to fetch the cover image URL for {link}.", "ERROR")
+
+# Function to turn a stream of track, album, artist and playlist links into unique (uri, cover URL, name) tracks.
+# known_track_info(uri) may return the (cover URL, name) of a track resolved by an earlier run.
+def iter_link_tracks(session, links, known_track_info=None):
+    seen = SeenSet()
+    pending_links = {}
+    pending_albums = []
+
+    for link in links:
+        kind, spotify_id = parse_spotify_link(link)
+        if not SPOTIFY_ID_PATTERN.fullmatch(spotify_id):
+            print_status(f"Not a valid Spotify link: {link}", "ERROR")
+            continue
+        if kind == "playlist":
+            yield from iter_unique_cover_tracks(iter_playlist_tracks(session, spotify_id), seen)
+            continue
 
-                # Sanitize track name for filename
-                sanitized_track_name = re.sub(r'[\s\\/*?"<>|]', "-", track_name)
-                sanitized_track_name = re.sub(r'[<>:"/\\|?*]', "-", sanitized_track_name)
+        if kind == "artist" and not seen.add(f"spotify:artist:{spotify_id}"):
+            continue
+        if kind in ("album", "artist"):
+            # Albums are looked up ALBUMS_BATCH_SIZE at a time, with every track of an album sharing its cover
+            album_ids = iter_artist_album_ids(session, spotify_id) if kind == "artist" else [spotify_id]
+            for album_id in album_ids:
+                if seen.add(f"spotify:album:{album_id}"):
+                    pending_albums.append(album_id)
+                if len(pending_albums) >= ALBUMS_BATCH_SIZE:
+                    yield from iter_unique_cover_tracks(iter_albums_tracks(session, pending_albums), seen)
+                    pending_albums = []
+            continue
 
-                # Get most used color
-                most_used_color = get_most_used_color(os.path.join(sanitized_playlist_name, f"{sanitized_track_name}.jpg"))
-                if most_used_color is None:
-                    print_status(f"Skipping {sanitized_track_name} due to missing cover image.", "WARNING")
-                    continue
+        spotify_uri = f"spotify:track:{spotify_id}"
+        if not seen.add(spotify_uri):
+            continue
 
-                background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
+        known = known_track_info(spotify_uri) if known_track_info else None
+        if known:
+            yield spotify_uri, *known
+            continue
 
-                # Determine best bar color
-                bar_color = determine_best_bar_color(most_used_color)
+        # Tracks in the metadata store need no request, so only misses fill the API batches
+        cached_track = metadata_store.get_track(spotify_id)
+        if cached_track:
+            album_cover_url, sanitized_track_name = extract_cover_info(cached_track)
+            if album_cover_url:
+                yield spotify_uri, album_cover_url, sanitized_track_name
+                continue
 
-                # Download Spotify code image with custom colors
-                code_output_path = os.path.join("Spotify_Codes", f"{sanitized_track_name}_code.png")
-                download_custom_spotify_code_image(session, spotify_uri, code_output_path, background_color, bar_color)
+        # Track links are looked up a batch at a time, so the first downloads start after one request
+        pending_links[spotify_id] = link
+        if len(pending_links) >= TRACKS_BATCH_SIZE:
+            yield from resolve_track_links(session, pending_links)
+            pending_links = {}
 
-                # Combine images
-                cover_image_path = os.path.join(sanitized_playlist_name, f"{sanitized_track_name}.jpg")
-                combined_output_path = os.path.join("Combined_Images", f"{sanitized_track_name}.jpg")
-                combine_images(cover_image_path, code_output_path, combined_output_path)
+    if pending_links:
+        yield from resolve_track_links(session, pending_links)
+    if pending_albums:
+        yield from iter_unique_cover_tracks(iter_albums_tracks(session, pending_albums), seen)
 
-                # Clean up individual images after combining
-                os.remove(cover_image_path)
-                os.remove(code_output_path)
+def process_song_links_from_file(file_path):
+    process_song_links(iter_song_links(file_path), song_links_folder_name(file_path))
 
-            # After processing, delete the Spotify_Codes and normal images folder
-            import shutil
-            shutil.rmtree("Spotify_Codes", ignore_errors=True)
-            shutil.rmtree(sanitized_playlist_name, ignore_errors=True)
+# Function to download the covers of a stream of links into a folder
+def process_song_links(spotify_links, output_folder_name):
+    os.makedirs(output_folder_name, exist_ok=True)
 
-            # Rename the Combined_Images folder to the playlist name
-            os.rename("Combined_Images", sanitized_playlist_name)
-            print_status(f"Renamed Combined_Images to {sanitized_playlist_name}", "SUCCESS")
+    if HTTP_ENGINE == "async":
+        asyncio.run(download_song_links_async(spotify_links, output_folder_name))
+        return
 
-def process_song_links_with_code_from_file(file_path):
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
+    with new_session() as session:
+        for spotify_uri, album_cover_url, sanitized_track_name in iter_link_tracks(session, spotify_links):
+            save_link_cover(session, output_folder_name, album_cover_url, sanitized_track_name)
 
-    output_folder_name = os.path.splitext(os.path.basename(file_path))[0]
-    os.makedirs(output_folder_name, exist_ok=True)
+# Function to render one track with its Spotify code. Like the other process_*_with_code functions it opens
+# its own sink and manifest unless the caller passes shared ones.
+def process_single_song_with_code(spotify_url, output=None, sink=None, manifest=None):
+    album_cover_url, sanitized_track_name = fetch_cover_image(spotify_url)
+    if not album_cover_url:
+        print_status("Failed to fetch the cover image URL.", "ERROR")
+        return
 
-    for line in lines:
-        spotify_url = line.strip()
-        if spotify_url:
-            album_cover_url, sanitized_track_name = fetch_cover_image(spotify_url)
-            if album_cover_url:
-                spotify_id = spotify_url.split("/")[-1].split("?")[0]
-                spotify_uri = f"spotify:track:{spotify_id}"
-                with requests.Session() as session:
-                    image_response = session.get(album_cover_url)
-                    if image_response.status_code == 200:
-                        with open(os.path.join(output_folder_name, f"{sanitized_track_name}.jpg"), "wb") as file:
-                            file.write(image_response.content)
-                        print_status(f"Cover image saved as {sanitized_track_name}.jpg in {output_folder_name}", "SUCCESS")
-                    else:
-                        print_status(f"Failed to download the cover image for {sanitized_track_name}.", "ERROR")
+    print_status(f"Cover Image URL: {album_cover_url}", "INFO")
 
-                # Get most used color
-                most_used_color = get_most_used_color(os.path.join(output_folder_name, f"{sanitized_track_name}.jpg"))
-                if most_used_color is None:
-                    print_status(f"Skipping {sanitized_track_name} due to missing cover image.", "WARNING")
-                    continue
+    # Extract the Spotify ID from the URL
+    spotify_id = extract_spotify_id(spotify_url)
+    spotify_uri = f"spotify:track:{spotify_id}"
 
-                background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
+    owns_sink = sink is None
+    if owns_sink:
+        sink, manifest = open_output_sink(output, "Combined_Images"), JobManifest()
+    try:
+        with new_session() as session:
+            render_track_with_code(session, sink, manifest, spotify_uri, album_cover_url, sanitized_track_name)
+    finally:
+        if owns_sink:
+            manifest.close()
+            sink.close()
+
+# Function to feed the playlist tracks that should_render accepts into the code pipeline
+def submit_playlist_tracks(session, pipeline, playlist_id, playlist_data, should_render):
+    playlist_tracks = {}
+    seen_names = set()
+    skipped = 0
+
+    for item in iter_playlist_items(session, playlist_id, playlist_data):
+        track = item["track"]
+        if not track or not track.get("album") or not track.get("name"):
+            print_status("Skipping unavailable track.", "WARNING")
+            continue
 
-                # Determine best bar color
-                bar_color = determine_best_bar_color(most_used_color)
+        album_cover_url, sanitized_track_name = extract_cover_info(track)
+        if not album_cover_url:
+            print_status(f"No images found for {track['name']}.", "WARNING")
+            continue
 
-                # Download Spotify code image with custom colors
-                code_output_path = os.path.join(output_folder_name, f"{sanitized_track_name}_code.png")
-                download_custom_spotify_code_image(session, spotify_uri, code_output_path, background_color, bar_color)
+        # Tracks sharing a name would write the same output at the same time
+        if sanitized_track_name in seen_names:
+            print_status(f"Skipping duplicate track name {sanitized_track_name}.", "WARNING")
+            continue
+        seen_names.add(sanitized_track_name)
+
+        spotify_uri = track_uri(track)
+        playlist_tracks[spotify_uri] = {"output": combined_image_name(sanitized_track_name), "added_at": item.get("added_at")}
+        if should_render(spotify_uri):
+            # Remember where the cover lives so the composite can be rebuilt offline later
+            pipeline.manifest.record(spotify_uri, "resolved", cover_url=album_cover_url, name=sanitized_track_name)
+            pipeline.submit(CodeJob(spotify_uri, album_cover_url, sanitized_track_name))
+        else:
+            skipped += 1
 
-                # Combine images
-                combined_output_path = os.path.join(output_folder_name, f"{sanitized_track_name}.jpg")
-                combine_images(os.path.join(output_folder_name, f"{sanitized_track_name}.jpg"), code_output_path, combined_output_path)
+    return playlist_tracks, skipped
 
-                # Clean up individual images after combining
-                os.remove(os.path.join(output_folder_name, f"{sanitized_track_name}_code.png"))
+def process_playlist_with_code(playlist_url, output=None, sink=None, manifest=None):
+    playlist_id = extract_spotify_id(playlist_url)
+    playlist_data = fetch_playlist(playlist_id)
 
-def merge_folders(cover_folder, code_folder, output_folder):
-    import os
-    from PIL import Image
+    # Ensure playlist_data is returned and valid
+    if not playlist_data:
+        print_status("Failed to fetch playlist data.", "ERROR")
+        return
 
-    os.makedirs(output_folder, exist_ok=True)
+    owns_sink = sink is None
+    if owns_sink:
+        sanitized_playlist_name = re.sub(r'[\s\\/*?"<>|]', "-", playlist_data["name"])
+        sink = open_output_sink(output, sanitized_playlist_name)
+        manifest = open_job_manifest(sink)
+
+    # Download covers and Spotify codes and combine images, all stages running concurrently
+    try:
+        with new_session() as session:
+            with CodePipeline(session, sink, manifest) as pipeline:
+                # Tracks combined by an earlier run of this playlist are not redone
+                _, skipped = submit_playlist_tracks(session, pipeline, playlist_id, playlist_data, lambda uri: not manifest.is_done(uri))
+    finally:
+        if owns_sink:
+            manifest.close()
+            sink.close()
+
+    if skipped:
+        print_status(f"Skipped {skipped} tracks already combined by an earlier run", "INFO")
+    print_status(f"Combined {pipeline.completed} tracks, {pipeline.failed} failed", "INFO")
+
+# Name of the file keeping the snapshot a playlist was last synced from, one per playlist so several can share a folder
+SYNC_STATE_FILE_PATTERN = ".spotyscan_sync.{}.json"
+
+# Function to read a sync state file, returning an empty state when it is missing or unreadable
+def read_sync_state_file(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    try:
+        with open(state_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        print_status(f"Ignoring unreadable sync state {state_path}", "WARNING")
+        return {}
+
+# Function to load the sync state of a playlist in a folder
+def load_sync_state(folder, playlist_id):
+    return read_sync_state_file(os.path.join(folder, SYNC_STATE_FILE_PATTERN.format(playlist_id)))
+
+# Function to save the sync state of a playlist in a folder
+def save_sync_state(folder, playlist_id, state):
+    write_file_atomic(os.path.join(folder, SYNC_STATE_FILE_PATTERN.format(playlist_id)), json.dumps(state, indent=2).encode("utf-8"))
+
+# Function to collect the images other playlists synced into a folder still use
+def other_synced_outputs(folder, playlist_id):
+    outputs = set()
+    prefix, suffix = SYNC_STATE_FILE_PATTERN.split("{}")
+    names = os.listdir(folder) if os.path.isdir(folder) else []
+    for name in names:
+        if name.startswith(prefix) and name.endswith(suffix) and name != SYNC_STATE_FILE_PATTERN.format(playlist_id):
+            state = read_sync_state_file(os.path.join(folder, name))
+            outputs.update(track["output"] for track in state.get("tracks", {}).values())
+    return outputs
+
+# Function to bring a playlist folder up to date, rendering only tracks added since the last sync
+def sync_playlist_with_code(playlist_url, output=None, prune=False):
+    playlist_id = extract_spotify_id(playlist_url)
+
+    # The snapshot ID changes whenever the playlist does, so checking it costs one tiny request
+    snapshot = fetch_playlist(playlist_id, fields="playlist_snapshot")
+    if not snapshot:
+        print_status("Failed to fetch playlist data.", "ERROR")
+        return
 
-    cover_files = sorted(os.listdir(cover_folder))
-    code_files = sorted(os.listdir(code_folder))
+    folder = output or re.sub(r'[\s\\/*?"<>|]', "-", snapshot["name"])
+    state = load_sync_state(folder, playlist_id)
+    pending_prune = prune and state.get("unpruned_tracks", 0) > 0
+    if state.get("snapshot_id") == snapshot["snapshot_id"] and not pending_prune:
+        print_status(f"{folder} is already up to date with snapshot {snapshot['snapshot_id']}", "SUCCESS")
+        return
 
-    for cover_file, code_file in zip(cover_files, code_files):
-        cover_path = os.path.join(cover_folder, cover_file)
-        code_path = os.path.join(code_folder, code_file)
+    playlist_data = fetch_playlist(playlist_id)
+    if not playlist_data:
+        print_status("Failed to fetch playlist data.", "ERROR")
+        return
 
-        if not os.path.exists(cover_path):
-            print_status(f"File not found: {cover_path}", "ERROR")
+    sink = FolderSink(folder)
+    manifest = open_job_manifest(sink)
+    try:
+        with new_session() as session:
+            with CodePipeline(session, sink, manifest) as pipeline:
+                playlist_tracks, _ = submit_playlist_tracks(session, pipeline, playlist_id, playlist_data, lambda uri: not manifest.is_done(uri))
+
+        # Tracks that left the playlist since the last sync
+        previous_tracks = state.get("tracks", {})
+        removed_uris = [uri for uri in previous_tracks if uri not in playlist_tracks]
+        if prune:
+            current_outputs = {track["output"] for track in playlist_tracks.values()}
+            # Images of tracks that are also in another playlist synced into this folder are kept
+            shared_outputs = other_synced_outputs(folder, playlist_id)
+            for uri in removed_uris:
+                output_name = previous_tracks[uri]["output"]
+                if output_name in shared_outputs:
+                    continue
+                if output_name not in current_outputs and sink.exists(output_name):
+                    os.remove(os.path.join(folder, output_name))
+                manifest.record(uri, "pruned")
+    finally:
+        manifest.close()
+
+    print_status(
+        f"Added {pipeline.completed} tracks, {pipeline.failed} failed, "
+        f"{len(removed_uris)} removed from the playlist{' and pruned' if prune else ''}",
+        "INFO",
+    )
+
+    # Only remember the snapshot once every track made it, so failed tracks are retried next time
+    synced_tracks = playlist_tracks if prune else {**previous_tracks, **playlist_tracks}
+    save_sync_state(folder, playlist_id, {
+        "playlist_id": playlist_id,
+        "snapshot_id": snapshot["snapshot_id"] if pipeline.failed == 0 else None,
+        "unpruned_tracks": len(synced_tracks) - len(playlist_tracks),
+        "tracks": synced_tracks,
+    })
+
+# Function to get the (cover URL, name) an earlier run stored for a track, if any
+def manifest_track_info(manifest, spotify_uri):
+    record = manifest.get(spotify_uri)
+    if "cover_url" in record:
+        return record["cover_url"], record["name"]
+    return None
+
+# Function to pass on the link-file tracks that still need rendering, remembering newly resolved ones
+def iter_pending_link_tracks(link_tracks, manifest):
+    skipped = 0
+    for spotify_uri, album_cover_url, sanitized_track_name in link_tracks:
+        record = manifest.get(spotify_uri)
+        if record.get("stage") == "composited":
+            skipped += 1
             continue
+        if "cover_url" not in record:
+            manifest.record(spotify_uri, "resolved", cover_url=album_cover_url, name=sanitized_track_name)
+        yield spotify_uri, album_cover_url, sanitized_track_name
+
+    if skipped:
+        print_status(f"Skipped {skipped} tracks already combined by an earlier run", "INFO")
+
+def process_song_links_with_code_from_file(file_path, output=None, sink=None, manifest=None):
+    process_song_links_with_code(iter_song_links(file_path), song_links_folder_name(file_path), output, sink, manifest)
+
+# Function to render the covers and Spotify codes of a stream of links
+def process_song_links_with_code(spotify_links, output_folder_name, output=None, sink=None, manifest=None):
+    owns_sink = sink is None
+    if owns_sink:
+        sink = open_output_sink(output, output_folder_name)
+        manifest = open_job_manifest(sink)
+
+    try:
+        if HTTP_ENGINE == "async":
+            asyncio.run(render_song_links_async(spotify_links, sink, manifest))
+            return
+
+        with new_session() as session:
+            # Tracks flow straight from the reader into the pipeline, whose submit blocks while it is full
+            with CodePipeline(session, sink, manifest) as pipeline:
+                link_tracks = iter_link_tracks(session, spotify_links, partial(manifest_track_info, manifest))
+                for spotify_uri, album_cover_url, sanitized_track_name in iter_pending_link_tracks(link_tracks, manifest):
+                    pipeline.submit(CodeJob(spotify_uri, album_cover_url, sanitized_track_name))
+    finally:
+        if owns_sink:
+            manifest.close()
+            sink.close()
+
+# Function to re-render every composite of an output folder from the image caches, without network access
+def rebuild_from_cache(folder):
+    global CACHE_ONLY
+
+    manifest_path = os.path.join(folder, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        print_status(f"No job manifest found in {folder}", "ERROR")
+        return
 
-        if not os.path.exists(code_path):
-            print_status(f"File not found: {code_path}", "ERROR")
+    sink = FolderSink(folder)
+    manifest = JobManifest(manifest_path)
+    # Stages go to a scratch manifest, so an evicted cache entry never marks a finished image as failed
+    scratch_manifest = JobManifest()
+    rebuilt = 0
+    missing = 0
+
+    CACHE_ONLY = True
+    try:
+        for spotify_uri, record in manifest.iter_records():
+            if "cover_url" not in record or record.get("stage") == "pruned":
+                continue
+            if render_track_with_code(None, sink, scratch_manifest, spotify_uri, record["cover_url"], record["name"]):
+                manifest.record(spotify_uri, "composited", output=combined_image_name(record["name"]))
+                rebuilt += 1
+            else:
+                missing += 1
+    finally:
+        CACHE_ONLY = False
+        scratch_manifest.close()
+        manifest.close()
+
+    print_status(f"Rebuilt {rebuilt} composites from the cache, {missing} not cached", "INFO")
+
+# Suffixes that mark a file as the Spotify code of the cover with the same stem (foo.jpg and foo_code.png)
+MERGE_CODE_SUFFIXES = ("_spotify_code", "_code", "-code", " code")
+
+# Image files merge_folders looks at
+MERGE_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# Number of pairs handed to a worker process at once when merging folders
+MERGE_CHUNK_SIZE = 32
+
+# Function to get the key pairing a cover with its Spotify code: the file stem without a code suffix
+def merge_key(file_name):
+    stem = os.path.splitext(file_name)[0]
+    for suffix in MERGE_CODE_SUFFIXES:
+        if stem.lower().endswith(suffix) and len(stem) > len(suffix):
+            return stem[:-len(suffix)]
+    return stem
+
+# Function to index the images of a folder by their merge key
+def index_merge_folder(folder):
+    index = {}
+    for file_name in sorted(os.listdir(folder)):
+        if not file_name.lower().endswith(MERGE_IMAGE_EXTENSIONS):
             continue
+        key = merge_key(file_name)
+        if key in index:
+            print_status(f"Ignoring {os.path.join(folder, file_name)}, {index[key]} has the same name", "WARNING")
+            continue
+        index[key] = file_name
+    return index
+
+# Function to merge one chunk of (cover path, code path, output path) pairs, run in a worker process
+def merge_pair_chunk(pairs, layout_name):
+    layout = composite_layout(layout_name)
+    results = []
+    for cover_path, code_path, output_path in pairs:
+        try:
+            # Save next to the output and swap it in, so an interrupted merge never leaves half an image
+            root, extension = os.path.splitext(output_path)
+            temp_path = f"{root}.{os.getpid()}.tmp{extension}"
+            with metrics.stage("composite"), Image.open(cover_path) as cover_img, Image.open(code_path) as code_img:
+                compositor.save(cover_img, code_img, layout, temp_path)
+            os.replace(temp_path, output_path)
+            results.append((output_path, None))
+        except (OSError, ValueError) as error:
+            results.append((output_path, str(error)))
+    return results
 
-        with Image.open(cover_path) as cover_img, Image.open(code_path) as code_img:
-            # Create a new image with the height of both images combined
-            combined_img = Image.new('RGB', (cover_img.width, cover_img.height + code_img.height))
-            combined_img.paste(cover_img, (0, 0))
-            combined_img.paste(code_img, (0, cover_img.height))
-
-            # Save the combined image with the same name as the cover
-            combined_img.save(os.path.join(output_folder, cover_file))
+def merge_folders(cover_folder, code_folder, output_folder):
+    os.makedirs(output_folder, exist_ok=True)
 
-            print_status(f"Merged {cover_file} with {code_file} into {output_folder}", "SUCCESS")
+    # Pair files by name once instead of by position, so one missing file cannot shift every later pair
+    covers = index_merge_folder(cover_folder)
+    codes = index_merge_folder(code_folder)
+
+    for key in sorted(covers.keys() - codes.keys()):
+        print_status(f"No Spotify code found for {os.path.join(cover_folder, covers[key])}", "WARNING")
+    for key in sorted(codes.keys() - covers.keys()):
+        print_status(f"No cover found for {os.path.join(code_folder, codes[key])}", "WARNING")
+
+    pairs = [
+        (os.path.join(cover_folder, covers[key]), os.path.join(code_folder, codes[key]), os.path.join(output_folder, covers[key]))
+        for key in sorted(covers.keys() & codes.keys())
+    ]
+    chunks = [pairs[start:start + MERGE_CHUNK_SIZE] for start in range(0, len(pairs), MERGE_CHUNK_SIZE)]
+
+    merged = 0
+    with ProcessPoolExecutor(max_workers=CPU_WORKERS) as pool:
+        futures = [submit_cpu_work(pool, merge_pair_chunk, chunk, LAYOUT) for chunk in chunks]
+        for future in as_completed(futures):
+            for output_path, error in future.result():
+                if error:
+                    print_status(f"Failed to merge {output_path}: {error}", "ERROR")
+                else:
+                    merged += 1
+                    print_status(f"Merged {os.path.basename(output_path)} into {output_folder}", "SUCCESS")
+
+    orphans = len(covers) + len(codes) - 2 * len(pairs)
+    print_status(f"Merged {merged} of {len(pairs)} pairs, {orphans} files without a partner", "INFO")
+
+# Address the render service listens on
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8000
+
+# Folder used to cache composites rendered by the render service
+RENDER_CACHE_DIR = os.path.join(".spotyscan_cache", "renders")
+
+# Maximum size of the render cache before the least recently used composites are evicted
+RENDER_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Total size of the composites the render service keeps in memory
+RENDER_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+# Content type of every supported output format
+OUTPUT_CONTENT_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+# One rendered composite and the ETag clients revalidate it with
+RenderedImage = namedtuple("RenderedImage", ["etag", "data"])
+
+# On-disk cache of composites rendered by the render service
+class RenderCache(ImageCache):
+    def __init__(self, cache_dir, max_bytes=RENDER_CACHE_MAX_BYTES):
+        super().__init__("render", cache_dir, max_bytes)
+
+# In-memory LRU of rendered composites, bounded by their total size
+class MemoryLRU:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+            return rendered
+
+    def put(self, key, rendered):
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= len(self._entries.pop(key).data)
+            self._entries[key] = rendered
+            self._total_bytes += len(rendered.data)
+
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted.data)
+
+# Long-running renderer behind the HTTP service, keeping its session, caches and worker processes warm
+class RenderService:
+    def __init__(self, cpu_workers=None):
+        self.session = HostLimitedSession()
+        self.memory_cache = MemoryLRU(RENDER_MEMORY_CACHE_BYTES)
+        self.disk_cache = RenderCache(RENDER_CACHE_DIR)
+        self._cpu_pool = start_cpu_pool(cpu_workers or CPU_WORKERS)
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+        # Fetch a token now, so the first request does not pay for it
+        get_access_token()
+
+    def close(self):
+        self._cpu_pool.shutdown()
+        self.session.close()
+
+    # Returns the composite of a track, None when Spotify could not be reached, and raises LookupError for unknown tracks
+    def get(self, track_id, layout_name, image_format):
+        key = f"{track_id}_{layout_name}_{image_format.lower()}"
+        rendered = self.memory_cache.get(key)
+        if rendered is not None:
+            metrics.add("cache_hits", cache="memory")
+            return rendered
+
+        # Concurrent requests for the same composite wait for the first one's render
+        with self._lock:
+            rendered = self.memory_cache.get(key)
+            if rendered is not None:
+                return rendered
+            future = self._rendering.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._rendering[key] = Future()
+
+        if not is_owner:
+            metrics.add("renders_coalesced")
+            return future.result()
+
+        try:
+            rendered = self._load_or_render(key, track_id, layout_name, image_format)
+            future.set_result(rendered)
+            return rendered
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._rendering[key]
+
+    def _load_or_render(self, key, track_id, layout_name, image_format):
+        data = self.disk_cache.load(key)
+        if data is None:
+            data = self._render(track_id, layout_name, image_format)
+            if data is None:
+                return None
+            self.disk_cache.store(key, data)
+
+        rendered = RenderedImage(f'"{hashlib.sha1(data).hexdigest()}"', data)
+        self.memory_cache.put(key, rendered)
+        return rendered
+
+    def _render(self, track_id, layout_name, image_format):
+        track_data = metadata_store.get_track(track_id)
+        if track_data is None:
+            response = spotify_api_request(f"/v1/tracks/{track_id}", session=self.session)
+            if response is None:
+                return None
+            if response.status_code in (400, 404):
+                raise LookupError(track_id)
+            if response.status_code != 200:
+                print_status(f"Error: Unable to fetch track data for {track_id}. {response.status_code}", "ERROR")
+                return None
+            track_data = response.json()
+            metadata_store.put_tracks([(track_id, track_data)])
+
+        album_cover_url, _ = extract_cover_info(track_data)
+        if not album_cover_url:
+            raise LookupError(track_id)
+
+        cover_bytes = cover_cache.read(self.session, album_cover_url)
+        if cover_bytes is None:
+            return None
+
+        most_used_color = submit_cpu_work(self._cpu_pool, get_most_used_color_from_bytes, cover_bytes, COLOR_PICKER, FAST_PICKER_QUANTIZE_BITS).result()
+        background_color = '{:02x}{:02x}{:02x}'.format(*most_used_color)
+        bar_color = determine_best_bar_color(most_used_color)
+
+        code_bytes = fetch_spotify_code_bytes(self.session, f"spotify:track:{track_id}", background_color, bar_color)
+        if code_bytes is None:
+            return None
+
+        return submit_cpu_work(self._cpu_pool, combine_image_bytes, cover_bytes, code_bytes, image_format, layout_name).result()
+
+# HTTP handler of the render service: GET /render/{track_id}?layout=...&format=...
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def log_message(self, format, *args):
+        print_status(f"{self.address_string()} {format % args}", "INFO")
+
+    def do_GET(self):
+        self.handle_render(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_render(send_body=False)
+
+    def handle_render(self, send_body):
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+        if parts.path == "/healthz":
+            return self.send_bytes(200, b"ok\n", "text/plain", send_body=send_body)
+
+        match = re.fullmatch(r"/render/([0-9A-Za-z]{22})", parts.path)
+        if not match:
+            return self.send_bytes(404, b"Use /render/{track_id}\n", "text/plain", send_body=send_body)
+
+        layout_name = query.get("layout", LAYOUT)
+        image_format = query.get("format", OUTPUT_FORMAT).upper()
+        if layout_name not in LAYOUT_TEMPLATES or image_format not in OUTPUT_EXTENSIONS:
+            return self.send_bytes(400, b"Unknown layout or format\n", "text/plain", send_body=send_body)
+
+        try:
+            rendered = self.service.get(match.group(1), layout_name, image_format)
+        except LookupError:
+            return self.send_bytes(404, b"Track not found\n", "text/plain", send_body=send_body)
+        except Exception as error:
+            print_status(f"Failed to render {match.group(1)}: {error}", "ERROR")
+            return self.send_bytes(500, b"Render failed\n", "text/plain", send_body=send_body)
+
+        if rendered is None:
+            return self.send_bytes(502, b"Spotify could not be reached\n", "text/plain", send_body=send_body)
+
+        headers = {"ETag": rendered.etag, "Cache-Control": "public, max-age=86400"}
+        if_none_match = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+        if rendered.etag in if_none_match or "*" in if_none_match:
+            return self.send_bytes(304, b"", None, headers, send_body=False)
+        self.send_bytes(200, rendered.data, OUTPUT_CONTENT_TYPES[image_format], headers, send_body=send_body)
+
+    def send_bytes(self, status, body, content_type, headers=None, send_body=True):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+# Function to serve composites over HTTP until interrupted
+def serve_renders(host=None, port=None):
+    host = host or SERVICE_HOST
+    port = port or SERVICE_PORT
+    service = RenderService()
+    handler = type("BoundRenderRequestHandler", (RenderRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    print_status(f"Serving composites on http://{host}:{port}/render/<track id>", "SUCCESS")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
 
 # Main program
-if __name__ == "__main__":
+# Function to run the original interactive menus
+def run_interactive_menu():
+    metrics.enabled = METRICS_FILE is not None
+
     print_colored("Choose an option:", Fore.CYAN)
     print_colored("1. Normal Cover Image Download", Fore.CYAN)
     print_colored("2. Download Cover Images with Spotify Codes", Fore.CYAN)
@@ -484,6 +2748,189 @@ if __name__ == "__main__":
     else:
         print_status("Invalid choice. Please enter 1, 2, or 3.", "ERROR")
 
+    print_request_stats()
+    write_run_metrics()
+
     # After processing, delete the Spotify_Codes folder
-    import shutil
     shutil.rmtree("Spotify_Codes", ignore_errors=True)
+
+# Function to tell playlist links apart from track links
+def is_playlist_link(link):
+    return "/playlist/" in link or link.startswith("spotify:playlist:")
+
+# Function to sort command line inputs into link files, playlist links and track links
+def split_inputs(inputs):
+    link_files, playlist_links, track_links = [], [], []
+    for item in inputs:
+        if item == "-" or os.path.isfile(item):
+            link_files.append(item)
+        elif is_playlist_link(item):
+            playlist_links.append(item)
+        else:
+            track_links.append(item)
+    return link_files, playlist_links, track_links
+
+# Function to tell whether links are a single track, which has its own flow
+def is_single_track(links):
+    return len(links) == 1 and parse_spotify_link(links[0])[0] == "track"
+
+# Function to run the cover subcommand
+def run_cover_command(args):
+    link_files, playlist_links, track_links = split_inputs(args.inputs)
+    for file_path in link_files:
+        process_song_links_from_file(file_path)
+    for playlist_url in playlist_links:
+        process_playlist(playlist_url)
+    if is_single_track(track_links):
+        process_single_song(track_links[0])
+    elif track_links:
+        process_song_links(track_links, "Song_Links")
+
+# Function to run the code subcommand
+def run_code_command(args):
+    link_files, playlist_links, track_links = split_inputs(args.inputs)
+
+    # With -o every input writes into one sink, which must only be opened once (a zip archive is rewritten on open)
+    sink = manifest = None
+    if args.output:
+        sink = open_output_sink(args.output, None)
+        manifest = open_job_manifest(sink)
+    try:
+        for file_path in link_files:
+            process_song_links_with_code_from_file(file_path, args.output, sink, manifest)
+        for playlist_url in playlist_links:
+            process_playlist_with_code(playlist_url, args.output, sink, manifest)
+        if is_single_track(track_links):
+            process_single_song_with_code(track_links[0], args.output, sink, manifest)
+        elif track_links:
+            process_song_links_with_code(track_links, "Combined_Images", args.output, sink, manifest)
+    finally:
+        if sink:
+            manifest.close()
+            sink.close()
+
+# Function to run the merge subcommand
+def run_merge_command(args):
+    merge_folders(args.cover_folder, args.code_folder, args.output)
+
+# Function to run the sync subcommand
+def run_sync_command(args):
+    # Each playlist syncs into its own folder, so one output folder cannot hold several
+    if args.output and len(args.playlists) > 1:
+        print_status("-o can only be used when syncing a single playlist.", "ERROR")
+        return
+    for playlist_url in args.playlists:
+        sync_playlist_with_code(playlist_url, args.output, prune=args.prune)
+
+# Function to run the rebuild subcommand
+def run_rebuild_command(args):
+    rebuild_from_cache(args.folder)
+
+# Function to run the serve subcommand
+def run_serve_command(args):
+    serve_renders(args.host, args.port)
+
+# Function to build the command line parser
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="spotyscan", description="Download Spotify cover images and Spotify codes.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors and warnings")
+    parser.add_argument("--log-format", choices=["text", "json"], default=LOG_FORMAT, help="format of status messages")
+    parser.add_argument("--engine", choices=["sync", "async"], default=HTTP_ENGINE, help="HTTP engine used for link files")
+    parser.add_argument("--workers", type=int, default=NETWORK_WORKERS, help="download threads of the image pipeline")
+    parser.add_argument("--cpu-workers", type=int, default=CPU_WORKERS, help="processes used for color picking and compositing")
+    parser.add_argument("--max-in-flight", type=int, default=PIPELINE_MAX_IN_FLIGHT, help="tracks inside the image pipeline at once")
+    parser.add_argument("--color-picker", choices=sorted(COLOR_PICKERS), default=COLOR_PICKER,
+                        help="how the Spotify code background color is picked: exact, or fast from a reduced-size decode")
+    parser.add_argument("--quantize-bits", type=int, choices=range(1, 8), metavar="1-7",
+                        help="bits kept per color channel by the fast picker, merging near-identical shades")
+    parser.add_argument("--pool-size", type=int, help="connections kept open per host (sized to the worker threads by default)")
+    parser.add_argument("--market", default=API_MARKET, help="market sent with API requests (tracks unavailable there are relinked, none is sent by default)")
+    parser.add_argument("--cache-dir", default=os.path.dirname(COVER_CACHE_DIR), help="folder of the image caches and the metadata store")
+    parser.add_argument("--token-cache", help=f"file keeping the access token between runs ({TOKEN_CACHE_FILE_NAME} in the cache folder by default, an empty string keeps it in memory)")
+    parser.add_argument("--metadata-ttl", type=float, metavar="HOURS", help="hours stored track, album and playlist metadata stays fresh (0 always asks the API)")
+    parser.add_argument("--metrics-file", default=METRICS_FILE, help="write per-stage timings and counters to this file at the end of the run")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], default=METRICS_FORMAT, help="format of the metrics file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    cover_parser = subparsers.add_parser("cover", help="download cover images")
+    cover_parser.add_argument("inputs", nargs="+", help="track, album, artist or playlist links, link files, or - to read links from stdin")
+    cover_parser.set_defaults(handler=run_cover_command)
+
+    code_parser = subparsers.add_parser("code", help="download cover images combined with Spotify codes")
+    code_parser.add_argument("inputs", nargs="+", help="track, album, artist or playlist links, link files, or - to read links from stdin")
+    code_parser.add_argument("-o", "--output", help="output folder, *.zip archive, or - to stream images to stdout")
+    code_parser.add_argument("--format", choices=sorted(OUTPUT_EXTENSIONS), type=str.upper, default=OUTPUT_FORMAT, help="format of combined images")
+    code_parser.add_argument("--layout", choices=sorted(LAYOUT_TEMPLATES), default=LAYOUT, help="layout of combined images")
+    code_parser.set_defaults(handler=run_code_command)
+
+    merge_parser = subparsers.add_parser("merge", help="merge song covers and Spotify codes from separate folders")
+    merge_parser.add_argument("cover_folder")
+    merge_parser.add_argument("code_folder")
+    merge_parser.add_argument("-o", "--output", default="merged", help="output folder")
+    merge_parser.add_argument("--layout", choices=sorted(LAYOUT_TEMPLATES), default=LAYOUT, help="layout of merged images")
+    merge_parser.set_defaults(handler=run_merge_command)
+
+    sync_parser = subparsers.add_parser("sync", help="bring playlist folders up to date with their playlists")
+    sync_parser.add_argument("playlists", nargs="+", help="playlist links")
+    sync_parser.add_argument("-o", "--output", help="output folder (defaults to the playlist name)")
+    sync_parser.add_argument("--prune", action="store_true", help="delete images of tracks removed from the playlist")
+    sync_parser.add_argument("--format", choices=sorted(OUTPUT_EXTENSIONS), type=str.upper, default=OUTPUT_FORMAT, help="format of combined images")
+    sync_parser.add_argument("--layout", choices=sorted(LAYOUT_TEMPLATES), default=LAYOUT, help="layout of combined images")
+    sync_parser.set_defaults(handler=run_sync_command)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="re-render an output folder from the caches without network access")
+    rebuild_parser.add_argument("folder", help="output folder with a job manifest")
+    rebuild_parser.add_argument("--format", choices=sorted(OUTPUT_EXTENSIONS), type=str.upper, default=OUTPUT_FORMAT, help="format of combined images")
+    rebuild_parser.add_argument("--layout", choices=sorted(LAYOUT_TEMPLATES), default=LAYOUT, help="layout of combined images")
+    rebuild_parser.set_defaults(handler=run_rebuild_command)
+
+    serve_parser = subparsers.add_parser("serve", help="render composites on demand over HTTP at /render/{track_id}")
+    serve_parser.add_argument("--host", default=SERVICE_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    serve_parser.add_argument("--format", choices=sorted(OUTPUT_EXTENSIONS), type=str.upper, default=OUTPUT_FORMAT, help="default format of composites")
+    serve_parser.add_argument("--layout", choices=sorted(LAYOUT_TEMPLATES), default=LAYOUT, help="default layout of composites")
+    serve_parser.set_defaults(handler=run_serve_command)
+
+    return parser
+
+# Function to run the command line, returning the exit code
+def run_cli(argv):
+    global QUIET, LOG_FORMAT, HTTP_ENGINE, NETWORK_WORKERS, CPU_WORKERS, PIPELINE_MAX_IN_FLIGHT, OUTPUT_FORMAT, LAYOUT, METRICS_FILE, METRICS_FORMAT, RENDER_CACHE_DIR, API_MARKET, HTTP_POOL_MAXSIZE, COLOR_PICKER, FAST_PICKER_QUANTIZE_BITS
+
+    args = build_arg_parser().parse_args(argv)
+    QUIET = args.quiet
+    LOG_FORMAT = args.log_format
+    HTTP_ENGINE = args.engine
+    NETWORK_WORKERS = args.workers
+    CPU_WORKERS = args.cpu_workers
+    PIPELINE_MAX_IN_FLIGHT = args.max_in_flight
+    API_MARKET = args.market
+    COLOR_PICKER = args.color_picker
+    FAST_PICKER_QUANTIZE_BITS = args.quantize_bits
+    if FAST_PICKER_QUANTIZE_BITS and COLOR_PICKER != "fast":
+        print_status("--quantize-bits only applies to the fast color picker.", "WARNING")
+    HTTP_POOL_MAXSIZE = args.pool_size
+    OUTPUT_FORMAT = getattr(args, "format", OUTPUT_FORMAT)
+    LAYOUT = getattr(args, "layout", LAYOUT)
+    cover_cache.cache_dir = os.path.join(args.cache_dir, "covers")
+    code_cache.cache_dir = os.path.join(args.cache_dir, "codes")
+    RENDER_CACHE_DIR = os.path.join(args.cache_dir, "renders")
+    metadata_store.path = os.path.join(args.cache_dir, os.path.basename(METADATA_DB_FILE))
+    token_cache = os.path.join(args.cache_dir, TOKEN_CACHE_FILE_NAME) if args.token_cache is None else args.token_cache
+    token_manager.set_cache_file(token_cache or None)
+    if args.metadata_ttl is not None:
+        for kind in METADATA_TTLS:
+            METADATA_TTLS[kind] = args.metadata_ttl * 3600
+    METRICS_FILE = args.metrics_file
+    METRICS_FORMAT = args.metrics_format
+    metrics.enabled = METRICS_FILE is not None
+
+    args.handler(args)
+    print_request_stats()
+    write_run_metrics()
+    return 1 if STATUS_COUNTS["ERROR"] else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    run_interactive_menu()
@@ -0,0 +1,480 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+from PIL import Image, ImageDraw
+
+from main import print_status
+
+# Loopback address each mocked service listens on, one per service so per-host limits behave like the real ones
+MOCK_HOSTS = {
+    "accounts": "127.0.0.1",
+    "api": "127.0.0.2",
+    "cdn": "127.0.0.3",
+    "codes": "127.0.0.4",
+}
+
+# Real host name of every mocked service
+REAL_HOSTS = {
+    "accounts": "accounts.spotify.com",
+    "api": "api.spotify.com",
+    "cdn": "i.scdn.co",
+    "codes": "scannables.scdn.co",
+}
+
+# Number of tracks sharing one album, and so one cover image
+TRACKS_PER_ALBUM = 10
+
+# Number of albums in the discography of one artist
+ALBUMS_PER_ARTIST = 60
+
+# Largest page sizes and batch sizes the real API accepts
+PLAYLIST_PAGE_LIMIT = 100
+ALBUM_PAGE_LIMIT = 50
+ARTIST_ALBUMS_PAGE_LIMIT = 50
+TRACKS_BATCH_LIMIT = 50
+ALBUMS_BATCH_LIMIT = 20
+
+# Markets every mock track and album is available in, as long as the real list
+MARKETS = (
+    "AD AE AG AL AM AO AR AT AU AZ BA BB BD BE BF BG BH BI BJ BN BO BR BS BT BW BY BZ CA CD CG CH CI CL CM CO CR CV "
+    "CW CY CZ DE DJ DK DM DO DZ EC EE EG ES ET FI FJ FM FR GA GB GD GE GH GM GN GQ GR GT GW GY HK HN HR HT HU ID IE "
+    "IL IN IQ IS IT JM JO JP KE KG KH KI KM KN KR KW KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MG MH MK ML MN "
+    "MO MR MT MU MV MW MX MY MZ NA NE NG NI NL NO NP NR NZ OM PA PE PG PH PK PL PR PS PT PW PY QA RO RS RW SA SB SC "
+    "SE SG SI SK SL SM SN SR ST SV SZ TD TG TH TJ TL TN TO TR TT TV TW TZ UA UG US UY UZ VC VE VN VU WS XK ZA ZM ZW"
+).split()
+
+# Function to build the 22 character Spotify ID of a mock track, album or artist
+def mock_id(prefix, index):
+    return f"{prefix}{index:021d}"
+
+# Function to generate a synthetic cover: a flat background with a noisy block, like real artwork
+def synthetic_cover(seed, size):
+    rng = random.Random(seed)
+    img = Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    block = size // 2
+    img.paste(Image.frombytes("RGB", (block, block), rng.randbytes(block * block * 3)), (size // 4, size // 4))
+
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+# Function to generate a synthetic Spotify code with the requested colors
+def synthetic_code(background_color, bar_color, size, spotify_uri):
+    img = Image.new("RGB", (size, size // 4), f"#{background_color}")
+    draw = ImageDraw.Draw(img)
+    fill = "white" if bar_color == "white" else "black"
+    rng = random.Random(spotify_uri)
+    bar_width = size // 60
+    for index in range(23):
+        height = rng.randint(2, 8) * size // 80
+        left = size // 4 + index * bar_width * 2
+        draw.rectangle([left, size // 8 - height // 2, left + bar_width, size // 8 + height // 2], fill=fill)
+
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+# Function to parse a fields filter such as "name,tracks(items(track(uri)))" into a tree of nested dicts.
+# An empty dict keeps the whole value.
+def parse_fields(spec):
+    stack = [{}]
+    name = ""
+    for char in spec:
+        if char not in ",()":
+            name += char.strip()
+            continue
+        if name:
+            stack[-1][name] = {}
+        if char == "(":
+            stack.append(stack[-1][name])
+        elif char == ")":
+            stack.pop()
+        name = ""
+    if name:
+        stack[-1][name] = {}
+    return stack[0]
+
+# Function to keep only the fields of a parsed fields filter
+def filter_fields(value, tree):
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [filter_fields(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: filter_fields(value[key], subtree) for key, subtree in tree.items() if key in value}
+    return value
+
+# Function to drop available_markets from a response the way the API does when a market is given,
+# carrying the market on to the next pages
+def apply_market(value, market):
+    if isinstance(value, list):
+        return [apply_market(item, market) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: f"{item}&market={market}" if key == "next" and item else apply_market(item, market)
+            for key, item in value.items() if key != "available_markets"
+        }
+    return value
+
+# HTTP server that stays quiet when a client drops its connection, which pool benchmarks do all the time
+class MockSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+# Local stand-in for the Spotify accounts service, Web API, image CDN and scannables service
+class MockSpotify:
+    def __init__(self, latency=0.0, rate_429=0.0, retry_after=0.1, cover_size=640, port=0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.cover_size = cover_size
+        self.port = port
+        self.calls = Counter()
+        self.bytes_sent = Counter()
+        self.connections = Counter()
+        self._lock = threading.Lock()
+        self._covers = {}
+        self._servers = {}
+
+    def start(self):
+        handler = type("MockSpotifyHandler", (MockSpotifyHandler,), {"mock": self})
+        for service, host in MOCK_HOSTS.items():
+            server = MockSpotifyServer((host, self.port), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers[service] = server
+        return self
+
+    def stop(self):
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def url(self, service):
+        host, port = self._servers[service].server_address
+        return f"http://{host}:{port}"
+
+    # Mapping from every real host name to the mock host standing in for it
+    def host_aliases(self):
+        return {REAL_HOSTS[service]: MOCK_HOSTS[service] for service in MOCK_HOSTS}
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent.clear()
+            self.connections.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "bytes": dict(self.bytes_sent), "connections": dict(self.connections)}
+
+    def count(self, service, endpoint, size):
+        with self._lock:
+            self.calls[f"{service} {endpoint}"] += 1
+            self.calls[service] += 1
+            self.bytes_sent[service] += size
+
+    def track_url(self, index):
+        return f"https://open.spotify.com/track/{mock_id('t', index)}"
+
+    def playlist_url(self, track_count):
+        return f"https://open.spotify.com/playlist/p{track_count}"
+
+    def album_url(self, album_index):
+        return f"https://open.spotify.com/album/{mock_id('a', album_index)}"
+
+    def artist_url(self, artist_index):
+        return f"https://open.spotify.com/artist/{mock_id('r', artist_index)}"
+
+    def artist(self, artist_index):
+        artist_id = mock_id("r", artist_index)
+        return {
+            "id": artist_id,
+            "name": f"Mock Artist {artist_index}",
+            "type": "artist",
+            "uri": f"spotify:artist:{artist_id}",
+            "href": f"{self.url('api')}/v1/artists/{artist_id}",
+            "external_urls": {"spotify": self.artist_url(artist_index)},
+        }
+
+    def album(self, album_index, full=True):
+        album_id = mock_id("a", album_index)
+        cover_hash = hashlib.sha1(album_id.encode("utf-8")).hexdigest()
+        album = {
+            "id": album_id,
+            "name": f"Mock Album {album_index}",
+            "type": "album",
+            "album_type": "album",
+            "uri": f"spotify:album:{album_id}",
+            "href": f"{self.url('api')}/v1/albums/{album_id}",
+            "external_urls": {"spotify": self.album_url(album_index)},
+            "release_date": "2024-01-01",
+            "release_date_precision": "day",
+            "total_tracks": TRACKS_PER_ALBUM,
+            "artists": [self.artist(album_index // ALBUMS_PER_ARTIST)],
+            "available_markets": MARKETS,
+            "images": [
+                {"url": f"{self.url('cdn')}/image/{cover_hash}", "height": 640, "width": 640},
+                {"url": f"{self.url('cdn')}/image/{cover_hash}?size=300", "height": 300, "width": 300},
+            ],
+        }
+        if full:
+            album["tracks"] = self.album_tracks_page(album_index, 0, ALBUM_PAGE_LIMIT)
+        return album
+
+    def track(self, index, with_album=True):
+        track_id = mock_id("t", index)
+        album_index = index // TRACKS_PER_ALBUM
+        track = {
+            "id": track_id,
+            "name": f"Mock Track {index}",
+            "type": "track",
+            "uri": f"spotify:track:{track_id}",
+            "href": f"{self.url('api')}/v1/tracks/{track_id}",
+            "external_urls": {"spotify": self.track_url(index)},
+            "external_ids": {"isrc": f"MOCK{index:08d}"},
+            "preview_url": f"{self.url('cdn')}/mp3-preview/{hashlib.sha1(track_id.encode('utf-8')).hexdigest()}",
+            "disc_number": 1,
+            "track_number": index % TRACKS_PER_ALBUM + 1,
+            "duration_ms": 180000,
+            "explicit": False,
+            "is_local": False,
+            "popularity": index % 100,
+            "artists": [self.artist(album_index // ALBUMS_PER_ARTIST)],
+            "available_markets": MARKETS,
+        }
+        if with_album:
+            track["album"] = self.album(album_index, full=False)
+        return track
+
+    def album_tracks_page(self, album_index, offset, limit):
+        first = album_index * TRACKS_PER_ALBUM
+        indexes = range(first + offset, first + min(TRACKS_PER_ALBUM, offset + limit))
+        next_offset = offset + limit
+        album_id = mock_id("a", album_index)
+        return {
+            "items": [self.track(index, with_album=False) for index in indexes],
+            "offset": offset,
+            "limit": limit,
+            "total": TRACKS_PER_ALBUM,
+            "next": f"{self.url('api')}/v1/albums/{album_id}/tracks?offset={next_offset}&limit={limit}" if next_offset < TRACKS_PER_ALBUM else None,
+        }
+
+    def artist_albums_page(self, artist_index, offset, limit):
+        first = artist_index * ALBUMS_PER_ARTIST
+        indexes = range(first + offset, first + min(ALBUMS_PER_ARTIST, offset + limit))
+        next_offset = offset + limit
+        artist_id = mock_id("r", artist_index)
+        return {
+            "items": [{**self.album(index, full=False), "album_group": "album"} for index in indexes],
+            "offset": offset,
+            "limit": limit,
+            "total": ALBUMS_PER_ARTIST,
+            "next": f"{self.url('api')}/v1/artists/{artist_id}/albums?offset={next_offset}&limit={limit}" if next_offset < ALBUMS_PER_ARTIST else None,
+        }
+
+    def playlist_page(self, playlist_id, offset, limit):
+        total = int(playlist_id[1:])
+        indexes = range(offset, min(total, offset + limit))
+        next_offset = offset + limit
+        return {
+            "items": [
+                {
+                    "added_at": f"2024-01-01T00:00:{index % 60:02d}Z",
+                    "added_by": {"id": "mock-user", "type": "user", "uri": "spotify:user:mock-user"},
+                    "is_local": False,
+                    "primary_color": None,
+                    "video_thumbnail": {"url": None},
+                    "track": self.track(index),
+                }
+                for index in indexes
+            ],
+            "offset": offset,
+            "limit": limit,
+            "total": total,
+            "next": f"{self.url('api')}/v1/playlists/{playlist_id}/tracks?offset={next_offset}&limit={limit}" if next_offset < total else None,
+        }
+
+    def cover(self, cover_hash):
+        with self._lock:
+            if cover_hash not in self._covers:
+                self._covers[cover_hash] = synthetic_cover(cover_hash, self.cover_size)
+            return self._covers[cover_hash]
+
+# Request handler serving every mocked endpoint
+class MockSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.handle_request()
+
+    def do_GET(self):
+        self.handle_request()
+
+    def setup(self):
+        super().setup()
+        # Every handler instance serves one client connection
+        service = next(name for name, host in MOCK_HOSTS.items() if host == self.server.server_address[0])
+        with self.mock._lock:
+            self.mock.connections[service] += 1
+
+    def handle_request(self):
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+
+        service = next(name for name, host in MOCK_HOSTS.items() if host == self.server.server_address[0])
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+        if service != "accounts" and random.random() < self.mock.rate_429:
+            return self.send_json(service, "429", 429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                  {"Retry-After": str(self.mock.retry_after)})
+
+        routes = {
+            "accounts": self.route_accounts,
+            "api": self.route_api,
+            "cdn": self.route_cdn,
+            "codes": self.route_codes,
+        }
+        routes[service](service, parts.path, query)
+
+    def route_accounts(self, service, path, query):
+        if path == "/api/token":
+            return self.send_json(service, "/api/token", 200, {"access_token": "mock-token", "token_type": "Bearer", "expires_in": 3600})
+        self.send_json(service, "404", 404, {"error": "not found"})
+
+    def route_api(self, service, path, query):
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self.send_json(service, "401", 401, {"error": {"status": 401, "message": "No token provided"}})
+
+        if path == "/v1/tracks":
+            ids = query.get("ids", "").split(",")
+            if len(ids) > TRACKS_BATCH_LIMIT:
+                return self.send_json(service, "/v1/tracks", 400, {"error": {"status": 400, "message": "Too many ids requested"}})
+            if not all(re.fullmatch(r"[0-9A-Za-z]{22}", track_id) for track_id in ids):
+                return self.send_json(service, "/v1/tracks", 400, {"error": {"status": 400, "message": "Invalid base62 id"}})
+            tracks = [self.mock.track(int(track_id[1:])) if re.fullmatch(r"t\d{21}", track_id) else None for track_id in ids]
+            return self.send_api_json(service, "/v1/tracks", query, {"tracks": tracks})
+
+        match = re.fullmatch(r"/v1/tracks/t(\d{21})", path)
+        if match:
+            return self.send_api_json(service, "/v1/tracks/{id}", query, self.mock.track(int(match.group(1))))
+
+        match = re.fullmatch(r"/v1/playlists/(p\d+)", path)
+        if match:
+            playlist_id = match.group(1)
+            playlist = {
+                "id": playlist_id,
+                "name": f"Mock Playlist {playlist_id[1:]}",
+                "snapshot_id": f"snapshot-{playlist_id}",
+                "tracks": self.mock.playlist_page(playlist_id, 0, PLAYLIST_PAGE_LIMIT),
+            }
+            return self.send_api_json(service, "/v1/playlists/{id}", query, playlist)
+
+        match = re.fullmatch(r"/v1/playlists/(p\d+)/tracks", path)
+        if match:
+            offset = int(query.get("offset", 0))
+            limit = min(int(query.get("limit", PLAYLIST_PAGE_LIMIT)), PLAYLIST_PAGE_LIMIT)
+            return self.send_api_json(service, "/v1/playlists/{id}/tracks", query, self.mock.playlist_page(match.group(1), offset, limit))
+
+        if path == "/v1/albums":
+            ids = query.get("ids", "").split(",")
+            if len(ids) > ALBUMS_BATCH_LIMIT:
+                return self.send_json(service, "/v1/albums", 400, {"error": {"status": 400, "message": "Too many ids requested"}})
+            if not all(re.fullmatch(r"[0-9A-Za-z]{22}", album_id) for album_id in ids):
+                return self.send_json(service, "/v1/albums", 400, {"error": {"status": 400, "message": "Invalid base62 id"}})
+            albums = [self.mock.album(int(album_id[1:])) if re.fullmatch(r"a\d{21}", album_id) else None for album_id in ids]
+            return self.send_api_json(service, "/v1/albums", query, {"albums": albums})
+
+        match = re.fullmatch(r"/v1/albums/a(\d{21})", path)
+        if match:
+            return self.send_api_json(service, "/v1/albums/{id}", query, self.mock.album(int(match.group(1))))
+
+        match = re.fullmatch(r"/v1/albums/a(\d{21})/tracks", path)
+        if match:
+            offset = int(query.get("offset", 0))
+            limit = min(int(query.get("limit", ALBUM_PAGE_LIMIT)), ALBUM_PAGE_LIMIT)
+            return self.send_api_json(service, "/v1/albums/{id}/tracks", query, self.mock.album_tracks_page(int(match.group(1)), offset, limit))
+
+        match = re.fullmatch(r"/v1/artists/r(\d{21})/albums", path)
+        if match:
+            offset = int(query.get("offset", 0))
+            limit = min(int(query.get("limit", ARTIST_ALBUMS_PAGE_LIMIT)), ARTIST_ALBUMS_PAGE_LIMIT)
+            return self.send_api_json(service, "/v1/artists/{id}/albums", query, self.mock.artist_albums_page(int(match.group(1)), offset, limit))
+
+        self.send_json(service, "404", 404, {"error": {"status": 404, "message": "Service not found"}})
+
+    def send_api_json(self, service, endpoint, query, payload):
+        if query.get("market"):
+            payload = apply_market(payload, query["market"])
+        # Like the real API, only the playlist endpoints filter fields
+        if query.get("fields") and endpoint.startswith("/v1/playlists"):
+            payload = filter_fields(payload, parse_fields(query["fields"]))
+        self.send_json(service, endpoint, 200, payload)
+
+    def route_cdn(self, service, path, query):
+        match = re.fullmatch(r"/image/([0-9a-f]+)", path)
+        if match:
+            return self.send_body(service, "/image/{hash}", 200, self.mock.cover(match.group(1)), "image/jpeg")
+        self.send_json(service, "404", 404, {"error": "not found"})
+
+    def route_codes(self, service, path, query):
+        match = re.fullmatch(r"/uri/plain/jpeg/([0-9a-fA-F]{6})/(white|black)/(\d+)/(spotify:\w+:\w+)", path)
+        if match:
+            code = synthetic_code(match.group(1), match.group(2), int(match.group(3)), match.group(4))
+            return self.send_body(service, "/uri/plain/jpeg", 200, code, "image/jpeg")
+        self.send_json(service, "404", 404, {"error": "not found"})
+
+    def send_json(self, service, endpoint, status, payload, headers=None):
+        self.send_body(service, endpoint, status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def send_body(self, service, endpoint, status, body, content_type, headers=None):
+        self.mock.count(service, endpoint, len(body))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the Spotify services used by SpotyScan")
+    parser.add_argument("--port", type=int, default=8080, help="port every mocked service listens on")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After of injected 429 responses")
+    args = parser.parse_args()
+
+    mock = MockSpotify(latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after, port=args.port).start()
+    for service in MOCK_HOSTS:
+        print_status(f"{REAL_HOSTS[service]:<22} -> {mock.url(service)}", "INFO")
+    print_status(f"Example playlist: {mock.playlist_url(250)}", "INFO")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock.stop()